@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# Times the cost reporting steps on synthetic billing reports (see synthetic_billing.py) of a few sizes, and appends
+# one JSON line per size to a results file: seconds, CPU seconds, rows per second and peak RSS for each step (as
+# run_metrics records them), with the git commit measured, so runs of different versions can be compared.
+# Each size runs in a fresh process, so its peak RSS isn't inflated by the sizes before it.
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import cost_reporting_data
+from cost_reporting_data import SpreadsheetCache
+from run_metrics import metrics
+import synthetic_billing
+
+benchmark_month = "2015-06"
+benchmark_data_directory = "benchmark_data"  # generated zips, kept between runs
+benchmark_results = "benchmark_results.jsonl"
+
+
+def run_steps(zip_filename):
+    """Time each stage SpreadsheetCache and generate_reports go through for a month, on one zip: they record their
+    own stages (see run_metrics), so a benchmark measures what a real run does.
+    Returns (line items, the stage records: [{stage, parent, seconds, cpu_seconds, rows, ...}]).
+    """
+    sc = cost_reporting_data.SC = SpreadsheetCache(months=[benchmark_month], billing_zip=zip_filename)
+
+    output_directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(output_directory)  # the report functions write to reports/
+        os.mkdir("reports")
+        cost_reporting_data.generate_reports()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(output_directory)
+    return len(sc.spreadsheet), metrics.stages
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_size(size, args):
+    """Generate (or reuse) the zip for this size, time it in a child process, and return its results line"""
+    directory = os.path.join(benchmark_data_directory,
+                             "rows-%d-keepers-%d-resources-%d-usage-types-%d-churn-%g-seed-%d" %
+                             (size, args.keepers, args.resources, args.usage_types, args.tag_churn, args.seed))
+    zip_filename = os.path.join(directory, SpreadsheetCache.billing_zip_name(benchmark_month))
+    if not os.path.isfile(zip_filename):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        print "Generating " + zip_filename + "..."
+        synthetic_billing.generate(benchmark_month, size, args.keepers, args.resources, args.usage_types,
+                                   args.tag_churn, args.seed, directory)
+
+    print "Benchmarking " + str(size) + " rows..."
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', zip_filename],
+                             stdout=subprocess.PIPE)
+    output, _ = child.communicate()
+    line = {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(), 'generated_rows': size,
+            'keepers': args.keepers, 'resources': args.resources, 'usage_types': args.usage_types,
+            'tag_churn': args.tag_churn, 'seed': args.seed}
+    if child.returncode != 0:
+        line['error'] = "exit status " + str(child.returncode)  # e.g. killed for running out of memory
+    else:
+        line.update(json.loads(output.splitlines()[-1]))
+    return line
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the cost reporting steps on synthetic billing data")
+    parser.add_argument('--sizes', default="100000,1000000,10000000",
+                        help="comma-separated row counts (default 100000,1000000,10000000)")
+    parser.add_argument('--keepers', type=int, default=20)
+    parser.add_argument('--resources', type=int, default=2000)
+    parser.add_argument('--usage-types', type=int, default=4)
+    parser.add_argument('--tag-churn', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--results', default=benchmark_results, help="file to append results to")
+    parser.add_argument('--child', help=argparse.SUPPRESS)  # internal: time one zip and print the results
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.child:
+        sys.stdout = sys.stderr  # progress output; the results go to the real stdout
+        rows, steps = run_steps(args.child)
+        sys.__stdout__.write(json.dumps({'rows': rows, 'steps': steps}) + "\n")
+        sys.exit(0)
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        line = benchmark_size(size, args)
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(line, sort_keys=True) + "\n")
+        for step in line.get('steps', []):
+            name = ("  " if step['parent'] else "") + step['stage']  # stages inside another one are indented
+            print "  %-20s %8.2fs %12s rows/s %9.1f MB" % (name, step['seconds'], step['rows_per_second'],
+                                                           step['peak_rss_mb'])
+        if 'error' in line:
+            print "  failed: " + line['error']
@@ -0,0 +1,127 @@
+# Persisted, pre-aggregated state of one month's billing report, so a run only has to parse the line items
+# AWS appended since the last run, and reports over several months never re-parse a month already stored.
+# The reports don't need individual line items, only:
+#   - cost per (ResourceId, Operation, UsageType, ProductName, AvailabilityZone)
+#   - per resource, the few line items that decide its back-filled KEEP and PROD tags
+#   - cost per (ResourceId, ProductName, day), for the daily trend (DailyCosts)
+# All of it can be updated one line item at a time, in any order, and still give the same answer as
+# SpreadsheetCache's sort_data + get_resource_tags + tag_past_items over the whole month.
+
+import cPickle
+import os
+
+from daily_costs import DailyCosts
+
+# The billing store: one partition (pickled snapshot) per month
+billing_store_directory = "billing_store"
+snapshot_filename_format = billing_store_directory + "/%s.pickle"  # % year_month
+daily_costs_filename_format = billing_store_directory + "/%s_daily.pickle"  # % the months, see DailyCostMatrix
+rollup_cube_filename_format = billing_store_directory + "/%s_cube.pickle"  # % year_month, see RollupCube
+snapshot_version = 4  # bump when the stored state changes meaning; older snapshots are rebuilt from scratch
+
+
+class BillingSnapshot(object):
+    def __init__(self, year_month):
+        self.year_month = year_month
+        self.watermark = {'bytes': 0, 'crc': 0}  # how much of the month's CSV is already in here
+        self.keepers = set()  # KEEP tags as they appear on line items, before back-filling
+        self.version = snapshot_version
+        self.source_etag = None  # ETag of the S3 report everything up to the watermark came from
+        # key = (ResourceId, Operation, UsageType, ProductName, AvailabilityZone), value = cost in cost units
+        self.costs = {}
+        # key = resource id, value = {'first': ..., 'latest_keep': ..., 'last_prod': ...} (see add())
+        self.resources = {}
+        self.daily = DailyCosts()
+
+    @staticmethod
+    def load(year_month):
+        """Snapshot saved by an earlier run for this month, or a new empty one"""
+        filename = snapshot_filename_format % year_month
+        if not os.path.isfile(filename):
+            return BillingSnapshot(year_month)
+        with open(filename, 'rb') as f:
+            snapshot = cPickle.load(f)
+        if getattr(snapshot, 'version', 1) != snapshot_version:
+            return BillingSnapshot(year_month)
+        return snapshot
+
+    def save(self):
+        if not os.path.isdir(billing_store_directory):
+            os.makedirs(billing_store_directory)
+        filename = snapshot_filename_format % self.year_month
+        with open(filename + ".tmp", 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename + ".tmp", filename)
+
+    def add(self, row, hours):
+        """Fold one line item (hours = its SpreadsheetCache.get_time_comparator value) into the snapshot.
+        sort_data orders a resource's line items by this key, and tag resolution depends only on:
+          first: the line item that sorts first; its tags are the fallback and its Operation goes in the reports
+          latest_keep: the non-blank KEEP with the most hours, the first in sort order among ties
+          last_prod: the non-blank PROD that sorts last
+        Ties on the sort key fall back to file order, i.e. earlier line items before later ones.
+        """
+        key = (row['ResourceId'], row['Operation'], row['UsageType'], row['ProductName'], row['AvailabilityZone'])
+        self.costs[key] = self.costs.get(key, 0) + row['Cost']
+        self.daily.add(row)
+        self.add_tags(row, hours)
+
+    def add_tags(self, row, hours):
+        """The tag resolution half of add(), for when the costs are summed somewhere else"""
+        keep = row['user:KEEP'].upper()
+        prod = row['user:PROD'].lower()
+        self.keepers.add(keep)
+
+        sort_key = (keep, prod, row['Operation'], row['UsageType'], row['Cost'])
+        resource = self.resources.get(row['ResourceId'])
+        if resource is None:
+            resource = self.resources[row['ResourceId']] = {'first': None, 'latest_keep': None, 'last_prod': None}
+        if resource['first'] is None or sort_key < resource['first'][0]:
+            resource['first'] = (sort_key, hours, row['Operation'])
+        if len(keep.strip()) != 0:
+            latest = resource['latest_keep']
+            if latest is None or hours > latest[0] or (hours == latest[0] and sort_key < latest[1]):
+                resource['latest_keep'] = (hours, sort_key)
+        if len(prod.strip()) != 0:
+            if resource['last_prod'] is None or sort_key >= resource['last_prod']:
+                resource['last_prod'] = sort_key
+
+    def resource_tags(self, res_id):
+        """(KEEP, PROD) every line item of this resource gets once past items are tagged"""
+        resource = self.resources[res_id]
+        first_key, first_hours, _ = resource['first']
+        keep, prod = first_key[0], first_key[1]
+        if resource['latest_keep'] is not None and resource['latest_keep'][0] > first_hours:
+            keep = resource['latest_keep'][1][0]
+        if resource['last_prod'] is not None:
+            prod = resource['last_prod'][1]
+        return keep, prod
+
+    def line_items(self):
+        """One tagged pseudo line item per cost key, with the summed cost. Good for anything that only sums."""
+        tags = dict((res_id, self.resource_tags(res_id)) for res_id in self.resources)
+        items = []
+        for (res_id, operation, usage_type, product, zone), cost in sorted(self.costs.items()):
+            items.append({'ResourceId': res_id, 'user:KEEP': tags[res_id][0], 'user:PROD': tags[res_id][1],
+                          'Operation': operation, 'UsageType': usage_type, 'ProductName': product,
+                          'AvailabilityZone': zone, 'Cost': cost})
+        return items
+
+    def build_cost_tree(self, cube_cells):
+        """Same tree as SpreadsheetCache.build_cost_tree, from the stored sums, also adding them to cube_cells"""
+        tags = dict((res_id, self.resource_tags(res_id)) for res_id in self.resources)
+        tree = {}
+        for (res_id, operation, usage_type, product, zone), cost in sorted(self.costs.items()):
+            keep, prod = tags[res_id]
+            cell = (keep, prod, product, usage_type, zone, operation)
+            cube_cells[cell] = cube_cells.get(cell, 0) + cost
+            resources = tree.setdefault(keep, {}).setdefault(prod, {})
+            resource = resources.get(res_id)
+            if resource is None:
+                resource = resources[res_id] = {'Operation': self.resources[res_id]['first'][2], 'usage_types': {}}
+            usage = resource['usage_types'].get(usage_type)
+            if usage is None:
+                usage = resource['usage_types'][usage_type] = {'Cost': 0, 'zones': set()}
+            usage['Cost'] += cost
+            usage['zones'].add(zone)
+        return tree
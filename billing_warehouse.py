@@ -0,0 +1,153 @@
+# Local SQLite warehouse of tagged billing line items, one load per month.
+# Loading is a batched executemany in one transaction; the reports are then grouped queries, and rerunning
+# reports for a month that is already loaded (same S3 ETag, same tagging) skips downloading and parsing entirely.
+# Ad-hoc questions can go straight to the database file with the sqlite3 shell.
+
+from itertools import islice
+import sqlite3
+
+from daily_costs import DailyCosts
+
+warehouse_filename = "billing_warehouse.sqlite"
+load_batch_size = 10000
+
+schema = """
+CREATE TABLE IF NOT EXISTS line_items (
+    month TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    keep TEXT NOT NULL,
+    prod TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    usage_type TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    availability_zone TEXT NOT NULL,
+    usage_start_date TEXT NOT NULL,
+    cost INTEGER NOT NULL  -- cost units, see cost_reporting_data.cost_scale
+);
+CREATE INDEX IF NOT EXISTS line_items_resource_id ON line_items (month, resource_id);
+CREATE INDEX IF NOT EXISTS line_items_keep ON line_items (month, keep);
+CREATE INDEX IF NOT EXISTS line_items_prod ON line_items (month, prod);
+CREATE INDEX IF NOT EXISTS line_items_usage_type ON line_items (month, usage_type);
+CREATE INDEX IF NOT EXISTS line_items_usage_start_date ON line_items (month, usage_start_date);
+CREATE TABLE IF NOT EXISTS keepers (
+    month TEXT NOT NULL,
+    keep TEXT NOT NULL  -- KEEP tags as they appear on line items, before back-filling
+);
+CREATE TABLE IF NOT EXISTS loads (
+    month TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,  -- of the S3 report that was loaded
+    tagging TEXT NOT NULL,  -- 'latest' or 'hourly', how past items were tagged
+    line_items INTEGER NOT NULL
+);
+"""
+
+# line item dict key -> column
+columns = [('ResourceId', 'resource_id'), ('user:KEEP', 'keep'), ('user:PROD', 'prod'), ('Operation', 'operation'),
+           ('UsageType', 'usage_type'), ('ProductName', 'product_name'), ('AvailabilityZone', 'availability_zone'),
+           ('UsageStartDate', 'usage_start_date'), ('Cost', 'cost')]
+
+
+class BillingWarehouse(object):
+    def __init__(self, filename=warehouse_filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.conn.executescript(schema)
+
+    def is_loaded(self, month, etag, tagging):
+        row = self.conn.execute("SELECT etag, tagging FROM loads WHERE month = ?", (month,)).fetchone()
+        return row is not None and tuple(row) == (etag, tagging)
+
+    def load(self, month, etag, tagging, line_items, keepers):
+        """Replace the month's line items (already tagged, in SpreadsheetCache's sorted order) and keepers"""
+        insert = "INSERT INTO line_items (month, " + ", ".join(column for _, column in columns) + \
+                 ") VALUES (?" + ", ?"*len(columns) + ")"
+        rows = ((month,) + tuple(row[key] for key, _ in columns) for row in line_items)
+        count = 0
+        with self.conn:  # one transaction
+            self.conn.execute("DELETE FROM line_items WHERE month = ?", (month,))
+            self.conn.execute("DELETE FROM keepers WHERE month = ?", (month,))
+            self.conn.execute("DELETE FROM loads WHERE month = ?", (month,))
+            while True:
+                batch = list(islice(rows, load_batch_size))
+                if not batch:
+                    break
+                self.conn.executemany(insert, batch)
+                count += len(batch)
+            self.conn.executemany("INSERT INTO keepers (month, keep) VALUES (?, ?)",
+                                  [(month, keep) for keep in set(keepers)])
+            self.conn.execute("INSERT INTO loads (month, etag, tagging, line_items) VALUES (?, ?, ?, ?)",
+                              (month, etag, tagging, count))
+        print "Loaded " + str(count) + " line items for " + month + " into " + warehouse_filename
+
+    @staticmethod
+    def months_clause(months):
+        return "month IN (" + ", ".join("?"*len(months)) + ")"
+
+    def line_items(self, months):
+        """Line item dicts, like SpreadsheetCache.data(), straight from a cursor"""
+        cursor = self.conn.execute("SELECT " + ", ".join(column for _, column in columns) + " FROM line_items WHERE " +
+                                   self.months_clause(months) + " ORDER BY rowid", months)
+        for row in cursor:
+            yield dict((key, value) for (key, _), value in zip(columns, row))
+
+    def keepers(self, months):
+        cursor = self.conn.execute("SELECT DISTINCT keep FROM keepers WHERE " + self.months_clause(months), months)
+        return [keep for keep, in cursor]
+
+    def cost_tree(self, months):
+        """SpreadsheetCache.build_cost_tree as three grouped queries"""
+        where = " FROM line_items WHERE " + self.months_clause(months)
+        tree = {}
+        # a resource's Operation is the one on its first line item (lowest rowid, as loaded in sorted order)
+        for keep, prod, res_id, operation in self.conn.execute(
+                "SELECT keep, prod, resource_id, operation FROM line_items WHERE rowid IN "
+                "(SELECT MIN(rowid)" + where + " GROUP BY keep, prod, resource_id)", months):
+            tree.setdefault(keep, {}).setdefault(prod, {})[res_id] = {'Operation': operation, 'usage_types': {}}
+        for keep, prod, res_id, usage_type, cost in self.conn.execute(
+                "SELECT keep, prod, resource_id, usage_type, SUM(cost)" + where +
+                " GROUP BY keep, prod, resource_id, usage_type", months):
+            tree[keep][prod][res_id]['usage_types'][usage_type] = {'Cost': cost, 'zones': set()}
+        for keep, prod, res_id, usage_type, zone in self.conn.execute(
+                "SELECT DISTINCT keep, prod, resource_id, usage_type, availability_zone" + where, months):
+            tree[keep][prod][res_id]['usage_types'][usage_type]['zones'].add(zone)
+        return tree
+
+    def rollup_cube(self, months):
+        """{month: its RollupCube cells} as one grouped query"""
+        dimensions = "keep, prod, product_name, usage_type, availability_zone, operation"  # in DIMENSIONS order
+        cursor = self.conn.execute("SELECT month, " + dimensions + ", SUM(cost) FROM line_items WHERE " +
+                                   self.months_clause(months) + " GROUP BY month, " + dimensions, months)
+        cells = {}
+        for row in cursor:
+            cells.setdefault(row[0], {})[tuple(row[1:-1])] = row[-1]
+        return cells
+
+    def daily_costs(self, months):
+        """DailyCosts by (KEEP, PROD), product and day as one grouped query"""
+        daily = DailyCosts()
+        for keep, prod, product, day, cost in self.conn.execute(
+                "SELECT keep, prod, product_name, substr(usage_start_date, 1, 10) AS day, SUM(cost)"
+                " FROM line_items WHERE " + self.months_clause(months) + " GROUP BY keep, prod, product_name, day",
+                months):
+            daily.costs[((keep, prod), product, day)] = cost
+        return daily
+
+    def untagged_rollup(self, months):
+        """cost_reporting_data.rollup_untagged as grouped queries"""
+        where = " FROM line_items WHERE " + self.months_clause(months) + " AND TRIM(keep) = ''"
+        rollup = {}
+        for field, column in [('ResourceId', 'resource_id'), ('Operation', 'operation'), ('UsageType', 'usage_type')]:
+            groups = rollup[field] = {}
+            for value, cost in self.conn.execute("SELECT " + column + ", SUM(cost)" + where + " GROUP BY " + column,
+                                                 months):
+                groups[value] = {'Cost': cost, 'products': set()}
+            for value, product in self.conn.execute("SELECT DISTINCT " + column + ", product_name" + where, months):
+                groups[value]['products'].add(product)
+        # instr, not LIKE: LIKE is case-insensitive, the report's "in" checks are not
+        rollup['volume'], rollup['s3'], rollup['usage_type_egress'], rollup['operation_egress'] = [
+            total or 0 for total in self.conn.execute(
+                "SELECT SUM(CASE WHEN instr(usage_type, 'Volume') THEN cost ELSE 0 END),"
+                " SUM(CASE WHEN instr(product_name, 'Amazon Simple Storage Service') THEN cost ELSE 0 END),"
+                " SUM(CASE WHEN instr(usage_type, 'Out') THEN cost ELSE 0 END),"
+                " SUM(CASE WHEN instr(operation, 'Out') THEN cost ELSE 0 END)" + where, months).fetchone()]
+        return rollup
@@ -0,0 +1,241 @@
+# Columnar, dictionary-encoded storage for billing line items.
+# Every string column is kept as an array of integer codes into a list of distinct values, Cost as an int64 array
+# of cost units (see cost_reporting_data.cost_scale).
+# Case-fixing, tag back-filling and subtotals then work on a few hundred distinct values plus numpy array ops,
+# instead of copying a list of per-row dicts around.
+# Needs numpy; cost_reporting_data.py only imports this module when asked for the columnar backend.
+
+from array import array
+import numpy
+
+STRING_FIELDS = ['ResourceId', 'user:KEEP', 'user:PROD', 'Operation', 'UsageType', 'ProductName',
+                 'AvailabilityZone', 'UsageStartDate']
+
+
+class EncodedColumn(object):
+    """One string column: codes[i] is the index into values for row i"""
+    def __init__(self):
+        self.values = []
+        self.index = {}  # key = value, value = code
+        self.codes = array('i')
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def freeze(self):
+        """Swap the growable array for a numpy one once loading is done"""
+        self.codes = numpy.frombuffer(self.codes, dtype=numpy.int32).copy()
+
+    def recode(self, transform):
+        """Apply transform to every distinct value, merging values that become equal. Vectorized over rows."""
+        values = []
+        index = {}
+        remap = numpy.empty(len(self.values), dtype=numpy.int32)
+        for old_code, value in enumerate(self.values):
+            value = transform(value)
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(values)
+                values.append(value)
+            remap[old_code] = code
+        self.values = values
+        self.index = index
+        self.codes = remap[self.codes]
+
+    def ranks(self):
+        """Code -> position of its value in sorted order, so rows can be sorted by value without decoding"""
+        ranks = numpy.empty(len(self.values), dtype=numpy.int32)
+        ranks[sorted(range(len(self.values)), key=self.values.__getitem__)] = numpy.arange(len(self.values))
+        return ranks
+
+
+class ColumnarSpreadsheet(object):
+    """Drop-in for the list of line-item dicts: len(), indexing and iteration hand back row dicts,
+    built on demand from the encoded columns.
+    """
+    def __init__(self, line_items):
+        self.columns = dict((field, EncodedColumn()) for field in STRING_FIELDS)
+        cost = array('l')
+        for row in line_items:
+            for field in STRING_FIELDS:
+                self.columns[field].append(row[field])
+            cost.append(row['Cost'])
+        for column in self.columns.values():
+            column.freeze()
+        self.cost = numpy.frombuffer(cost, dtype=numpy.dtype('l')).astype(numpy.int64)
+
+    def __len__(self):
+        return len(self.cost)
+
+    def __getitem__(self, i):
+        row = dict((field, column.values[column.codes[i]]) for field, column in self.columns.items())
+        row['Cost'] = int(self.cost[i])
+        return row
+
+    def __iter__(self):
+        decoded = [(field, column.values, column.codes.tolist()) for field, column in self.columns.items()]
+        for i, cost in enumerate(self.cost.tolist()):
+            row = dict((field, values[codes[i]]) for field, values, codes in decoded)
+            row['Cost'] = cost
+            yield row
+
+    def fix_case(self):
+        self.columns['user:KEEP'].recode(lambda value: value.upper())
+        self.columns['user:PROD'].recode(lambda value: value.lower())
+
+    def sort_data(self):
+        """Sort rows by ResourceId, KEEP, PROD, Operation, UsageType, Cost"""
+        keys = [self.cost]
+        for field in reversed(['ResourceId', 'user:KEEP', 'user:PROD', 'Operation', 'UsageType']):
+            column = self.columns[field]
+            keys.append(column.ranks()[column.codes])
+        order = numpy.lexsort(keys)  # last key is the primary one
+        for column in self.columns.values():
+            column.codes = column.codes[order]
+        self.cost = self.cost[order]
+
+    def hours(self):
+        """Hours since start of month for every row, parsed once per distinct UsageStartDate"""
+        column = self.columns['UsageStartDate']
+        by_code = numpy.zeros(len(column.values), dtype=numpy.int32)
+        for code, date_time in enumerate(column.values):
+            try:
+                by_code[code] = int(date_time[8:10])*24 + int(date_time[11:13])
+            except ValueError:
+                pass
+        return by_code[column.codes]
+
+    def resource_tags(self):
+        """Per resource code, the KEEP and PROD codes every line item of it should carry.
+        Same rules as SpreadsheetCache.get_resource_tags: the latest non-blank KEEP that is newer than the
+        resource's first line item, else that first line item's KEEP; the last non-blank PROD.
+        """
+        res = self.columns['ResourceId'].codes
+        keep_column = self.columns['user:KEEP']
+        prod_column = self.columns['user:PROD']
+        keep = keep_column.codes
+        prod = prod_column.codes
+        hours = self.hours()
+        n_res = len(self.columns['ResourceId'].values)
+
+        first = numpy.full(n_res, -1, dtype=numpy.int64)
+        unique_res, first_rows = numpy.unique(res, return_index=True)
+        first[unique_res] = first_rows
+        res_keep = keep[first].copy()
+        res_prod = prod[first].copy()
+
+        keep_blank = numpy.array([len(value.strip()) == 0 for value in keep_column.values], dtype=bool)
+        newer = ~keep_blank[keep] & (hours > hours[first[res]])
+        rows = numpy.nonzero(newer)[0]
+        if len(rows):
+            # latest hour wins, the earliest row breaks ties
+            rows = rows[numpy.lexsort((rows, -hours[rows], res[rows]))]
+            winners_res, winners = numpy.unique(res[rows], return_index=True)
+            res_keep[winners_res] = keep[rows[winners]]
+
+        prod_blank = numpy.array([len(value.strip()) == 0 for value in prod_column.values], dtype=bool)
+        rows = numpy.nonzero(~prod_blank[prod])[0][::-1]  # reversed, so unique() finds the last row
+        if len(rows):
+            winners_res, winners = numpy.unique(res[rows], return_index=True)
+            res_prod[winners_res] = prod[rows[winners]]
+
+        return res_keep, res_prod
+
+    def tag_past_items(self):
+        """Tag untagged items if they became tagged at any time in the billing record"""
+        res_keep, res_prod = self.resource_tags()
+        res = self.columns['ResourceId'].codes
+        self.columns['user:KEEP'].codes = res_keep[res]
+        self.columns['user:PROD'].codes = res_prod[res]
+
+    def resource_tag_values(self):
+        """{resource id: (KEEP, PROD)} of the line items, once tag_past_items has given each resource one of each"""
+        res_column = self.columns['ResourceId']
+        keep_values = self.columns['user:KEEP'].values
+        prod_values = self.columns['user:PROD'].values
+        unique_res, first_rows = numpy.unique(res_column.codes, return_index=True)
+        keeps = self.columns['user:KEEP'].codes[first_rows].tolist()
+        prods = self.columns['user:PROD'].codes[first_rows].tolist()
+        return dict((res_column.values[res], (keep_values[keep], prod_values[prod]))
+                    for res, keep, prod in zip(unique_res.tolist(), keeps, prods))
+
+    def distinct(self, field):
+        """Values of field that occur in at least one row"""
+        column = self.columns[field]
+        return [column.values[code] for code in numpy.unique(column.codes)]
+
+    def build_cost_tree(self):
+        """Same tree as SpreadsheetCache.build_cost_tree. Leaf costs are one integer scatter-add over the group codes."""
+        fields = ['user:KEEP', 'user:PROD', 'ResourceId', 'UsageType']
+        codes = numpy.column_stack([self.columns[field].codes for field in fields])
+        groups, first_rows, group_of_row = numpy.unique(codes, axis=0, return_index=True, return_inverse=True)
+        costs = numpy.zeros(len(groups), dtype=numpy.int64)
+        numpy.add.at(costs, group_of_row, self.cost)  # not bincount: its float weights would round the sums
+
+        zone_column = self.columns['AvailabilityZone']
+        zones = [set() for _ in range(len(groups))]
+        for group, zone in numpy.unique(numpy.column_stack([group_of_row, zone_column.codes]), axis=0).tolist():
+            zones[group].add(zone_column.values[zone])
+
+        operation_column = self.columns['Operation']
+        values = [self.columns[field].values for field in fields]
+        tree = {}
+        # visit groups in row order, so each resource keeps the Operation of its first line item
+        for group in numpy.argsort(first_rows, kind='mergesort').tolist():
+            keep, prod, res_id, usage_type = [values[j][code] for j, code in enumerate(groups[group].tolist())]
+            resources = tree.setdefault(keep, {}).setdefault(prod, {})
+            if res_id not in resources:
+                operation = operation_column.values[operation_column.codes[first_rows[group]]]
+                resources[res_id] = {'Operation': operation, 'usage_types': {}}
+            resources[res_id]['usage_types'][usage_type] = {'Cost': int(costs[group]), 'zones': zones[group]}
+        return tree
+
+    def untagged_rollup(self):
+        """Same rollup as cost_reporting_data.rollup_untagged, grouped and summed on the codes of the untagged rows"""
+        keep_column = self.columns['user:KEEP']
+        keep_blank = numpy.array([len(value.strip()) == 0 for value in keep_column.values], dtype=bool)
+        rows = numpy.nonzero(keep_blank[keep_column.codes])[0]
+        cost = self.cost[rows]
+        product_column = self.columns['ProductName']
+        products = product_column.codes[rows]
+        rollup = {}
+        for field in ('ResourceId', 'Operation', 'UsageType'):
+            column = self.columns[field]
+            codes = column.codes[rows]
+            groups = rollup[field] = {}
+            if not len(rows):
+                continue
+            values, group_of_row = numpy.unique(codes, return_inverse=True)
+            costs = numpy.zeros(len(values), dtype=numpy.int64)
+            numpy.add.at(costs, group_of_row, cost)
+            for code, group_cost in zip(values.tolist(), costs.tolist()):
+                groups[column.values[code]] = {'Cost': group_cost, 'products': set()}
+            for code, product in numpy.unique(numpy.column_stack([codes, products]), axis=0).tolist():
+                groups[column.values[code]]['products'].add(product_column.values[product])
+
+        def cost_where(field, text):
+            """Total cost of the untagged rows whose field contains text, testing each distinct value once"""
+            column = self.columns[field]
+            matches = numpy.array([text in value for value in column.values], dtype=bool)
+            return int(cost[matches[column.codes[rows]]].sum())
+
+        rollup['volume'] = cost_where('UsageType', "Volume")
+        rollup['s3'] = cost_where('ProductName', "Amazon Simple Storage Service")
+        rollup['usage_type_egress'] = cost_where('UsageType', "Out")
+        rollup['operation_egress'] = cost_where('Operation', "Out")
+        return rollup
+
+    def rollup_cube(self):
+        """RollupCube cells, grouped and summed on the codes; only the distinct groups are decoded"""
+        fields = ['user:KEEP', 'user:PROD', 'ProductName', 'UsageType', 'AvailabilityZone', 'Operation']
+        codes = numpy.column_stack([self.columns[field].codes for field in fields])
+        groups, group_of_row = numpy.unique(codes, axis=0, return_inverse=True)
+        costs = numpy.zeros(len(groups), dtype=numpy.int64)
+        numpy.add.at(costs, group_of_row, self.cost)
+        values = [self.columns[field].values for field in fields]
+        return dict((tuple(values[j][code] for j, code in enumerate(group)), cost)
+                    for group, cost in zip(groups.tolist(), costs.tolist()))
@@ -0,0 +1,42 @@
+# AWS connections shared by the scripts, so one can connect without importing another script and everything it
+# imports (the uploader doesn't need the billing code, the billing code doesn't need the inventory code).
+
+import os
+from boto import ec2
+from boto.ec2.connection import EC2Connection
+from boto.ec2.regioninfo import RegionInfo
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+
+billing_bucket = 'oicr.detailed.billing'  # detailed billing reports come in here, our reports go out to it
+ec2_api_version = '2016-11-15'  # boto's default predates MaxResults/NextToken on DescribeVolumes and DescribeSnapshots
+
+
+def s3_connection():
+    """S3 connection using the AWS_* environment variables.
+    Set S3_ENDPOINT=host:port to talk to a local S3 stand-in (moto_server, minio) over plain http instead.
+    """
+    access_key, secret_key = os.environ['AWS_ACCESS_KEY'], os.environ['AWS_SECRET_KEY']
+    endpoint = os.environ.get('S3_ENDPOINT')
+    if not endpoint:
+        return S3Connection(access_key, secret_key)
+    host, _, port = endpoint.partition(':')
+    return S3Connection(access_key, secret_key, host=host, port=int(port) if port else None, is_secure=False,
+                        calling_format=OrdinaryCallingFormat())
+
+
+def ec2_connection(region, credentials):
+    """EC2 connection to a region.
+    Set EC2_ENDPOINT=host:port to talk to a local EC2 stand-in (moto_server) over plain http instead.
+    """
+    endpoint = os.environ.get('EC2_ENDPOINT')
+    if not endpoint:
+        conn = ec2.connect_to_region(region, **credentials)
+    else:
+        host, _, port = endpoint.partition(':')
+        conn = EC2Connection(region=RegionInfo(name=region, endpoint=host), port=int(port) if port else None,
+                             is_secure=False, **credentials)
+        # SigV4 would otherwise take the service and region from the host name
+        conn._auth_handler.service_name = 'ec2'
+        conn._auth_handler.region_name = region
+    conn.APIVersion = ec2_api_version
+    return conn
@@ -1,60 +1,375 @@
 __author__ = 'cleung'
 
+import argparse
+import atexit
 import boto
 from boto import ec2
-from boto.s3.connection import S3Connection
+from boto.s3.key import Key
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import threading
+import hashlib
+import json
 import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
 import zipfile
+import zlib
 import os
 import csv
+from itertools import groupby
 from operator import itemgetter
 import pdb
 
+from billing_snapshot import BillingSnapshot, daily_costs_filename_format, rollup_cube_filename_format
+from connections import billing_bucket, ec2_connection, s3_connection
+from daily_costs import DailyCosts, DailyCostMatrix, tags_of_tagged
+from report_sink import ReportSink
+from rollup_cube import RollupCube
+from run_metrics import metrics
+from tag_timeline import TagTimeline
+
 # TODO: not using global variables!
 untagged_volume_sum = 0
 untagged_s3_sum = 0
 untagged_egress_sum = 0
 year_month = ""
 
+download_manifest = "billing_download_manifest.json"  # what we last downloaded, to skip unchanged reports
+download_part_size = 32*1024*1024  # bytes per ranged GET
+download_workers = 8
+
+# Billing report columns the reports use; everything else (mostly tag columns) is dropped while parsing
+LINE_ITEM_FIELDS = ['ResourceId', 'user:KEEP', 'user:PROD', 'Operation', 'UsageType', 'ProductName',
+                    'AvailabilityZone', 'UsageStartDate', 'Cost']
+
+report_months = []  # the "YYYY-MM" months being reported on, see period_description()
+
+# With a memory budget, line items are kept on disk as tuples of these, sorted in this order (see ExternalSort)
+SORTED_FIELDS = ['user:KEEP', 'user:PROD', 'ResourceId', 'UsageType', 'Operation', 'ProductName', 'AvailabilityZone',
+                 'UsageStartDate', 'Cost']
+line_item_bytes = 600  # rough size of one such tuple in memory, for turning a budget in MB into rows
+
+region_workers = 8  # regions whose live instances and volumes are listed at the same time
+
+# Costs are parsed once into integer units of 10^-10 dollars, the billing report's own precision, so sums are exact
+# and reconcile with the invoice. They are only turned back into decimal strings (format_cost) when written out.
+cost_decimals = 10
+cost_scale = 10**cost_decimals
+
+# Columns of the per-keeper reports; subtotal rows put their label and value in two extra columns
+report_fields = ['user:KEEP', 'ResourceId', 'Status, if available',
+                 'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost']
+report_subtotal_fields = report_fields + ['subtot', 'subval']
+
+daily_trend_output_file = "reports/daily_trend.csv"
+daily_spikes_output_file = "reports/daily_spikes.csv"
+spike_ratio = 2  # a keeper's cost for a day is a spike if it's at least this many times the day before's...
+spike_minimum = 10*cost_scale  # ...and at least this much ($10) more
+
+
+def parse_cost(cost):
+    """Cost string from the billing report -> exact integer number of 10^-cost_decimals dollars"""
+    whole, _, fraction = cost.partition('.')
+    if len(fraction) > cost_decimals or not (whole.lstrip('-') + fraction).isdigit():
+        # more precision than we keep, or exponent notation: let Decimal round it (slow, but rare)
+        return int(Decimal(cost).scaleb(cost_decimals).to_integral_value(ROUND_HALF_EVEN))
+    units = int(whole.lstrip('-') or '0')*cost_scale + int(fraction.ljust(cost_decimals, '0'))
+    return -units if whole.startswith('-') else units
+
+
+def format_cost(units):
+    """Exact decimal string for a number of cost units, e.g. 1234500000 -> '0.12345'"""
+    whole, fraction = divmod(abs(units), cost_scale)
+    fraction = str(fraction).rjust(cost_decimals, '0').rstrip('0') or '0'
+    return ('-' if units < 0 else '') + str(whole) + '.' + fraction
+
+
 class SpreadsheetCache(object):
-    def __init__(self):
-        self.filename = self.get_file_from_bucket()
-
-        self.spreadsheet = []
-        with open(self.filename) as f:
-            temp_reader = csv.DictReader(f)
-            for row in temp_reader:
-                if float(row['Cost']) != 0 and row['RecordType'] == "LineItem":
-                    if row['Operation'] == "" and row['UsageType'] == "":
-                        row['Operation'] = "ProductName" + row['ProductName']
-                        row['UsageType'] = "ProductName" + row['ProductName']
-                    self.spreadsheet.append(row)
-            del temp_reader
-
-        self.fix_case()
-        self.sort_data()
-
-        temp_keepers = set()
-        for row in self.spreadsheet:
-            temp_keepers.add(row['user:KEEP'])
-        self.keepers = list(temp_keepers)
-        del temp_keepers
+    def __init__(self, columnar=False, incremental=False, hourly_tags=False, months=None, warehouse=False,
+                 memory_budget=None, live_status=False, billing_zip=None):
+        """months: list of "YYYY-MM" to report on, default just the current month.
+        More than one month (or incremental) reads each month from its partition in the billing store (a saved
+        BillingSnapshot), which is only brought up to date from S3 if that month's report changed.
+        warehouse: load tagged line items into the SQLite BillingWarehouse (unless that month is already loaded)
+        and build the reports from grouped queries over it.
+        memory_budget: MB of line items to hold in memory at once; the rest are sorted on disk, and the reports
+        are built one keeper at a time from the sorted stream (see load_sorted_line_items).
+        live_status: look up every billed instance and volume in the live inventory (index_live_resources), for
+        the status columns of the reports.
+        billing_zip: a billing report zip on disk to read instead of the month's report in S3 (one month, not with
+        warehouse or incremental), e.g. a synthetic one for benchmark.py.
+        """
+        global year_month, report_months
+        report_months = months or [str(datetime.date.today().isoformat()[0:7])]  # current month by default
+        self.columnar = columnar
+        self.warehouse = None
+        self.sorted_line_items = None
+        self.daily_costs = None  # DailyCostMatrix, from a pass over the line items the backend already makes
+        # a RollupCube per month, its cells summed in whichever pass over the line items the backend already makes
+        self.cubes = dict((month, RollupCube([], [month])) for month in report_months)
+        self.live_resources = self.index_live_resources() if live_status else None
+        self.load(hourly_tags, warehouse, incremental, memory_budget, billing_zip)
+        self.keepers = sorted(self.keepers)  # the same order whatever the backend, so the summary is too
+        for cube in self.cubes.values():
+            cube.keepers = sorted(cube.keepers)
+
+    def load(self, hourly_tags, warehouse, incremental, memory_budget, billing_zip=None):
+        """Read report_months' line items with the backend asked for (see __init__), setting self.keepers, the
+        cost tree, or what stands in for it, and each month's cube
+        """
+        global year_month
+        if warehouse:
+            from billing_warehouse import BillingWarehouse
+            self.warehouse = BillingWarehouse()
+            tagging = 'hourly' if hourly_tags else 'latest'
+            for month in report_months:
+                key = self.get_billing_key(month)
+                if self.warehouse.is_loaded(month, key.etag, tagging):
+                    print "Billing warehouse is up to date for " + month
+                    continue
+                year_month = month
+                self.load_line_items(self.get_file_from_bucket(month, key), hourly_tags, daily_costs=False)
+                with metrics.stage('warehouse_load', rows=len(self.spreadsheet)):
+                    self.warehouse.load(month, key.etag, tagging, self.spreadsheet, self.keepers)
+            year_month = report_months[-1]
+            self.spreadsheet = None  # data() reads from the warehouse
+            self.keepers = self.warehouse.keepers(report_months)
+            with metrics.stage('cost_tree'):
+                self.cost_tree = self.warehouse.cost_tree(report_months)
+                for month, cells in self.warehouse.rollup_cube(report_months).items():
+                    self.cubes[month].cells = cells
+                for month in report_months:
+                    self.cubes[month].keepers = self.warehouse.keepers([month])
+                # the same for months loaded in this run and in earlier ones
+                self.daily_costs = DailyCostMatrix.build([(self.warehouse.daily_costs(report_months),
+                                                           tags_of_tagged)])
+            return
+
+        if incremental or len(report_months) > 1:
+            # reports come from the partitions' stored sums; each month's tags are resolved within that month
+            snapshots = [self.load_partition(month) for month in report_months]
+            year_month = report_months[-1]
+            self.spreadsheet = [line_item for snapshot in snapshots for line_item in snapshot.line_items()]
+            self.keepers = list(set().union(*[snapshot.keepers for snapshot in snapshots]))
+            self.daily_costs = DailyCostMatrix.build([(snapshot.daily, snapshot.resource_tags)
+                                                      for snapshot in snapshots])
+            for snapshot in snapshots:
+                self.cubes[snapshot.year_month].keepers = snapshot.keepers
+            with metrics.stage('cost_tree', rows=len(self.spreadsheet)):
+                self.cost_tree = self.merge_cost_trees([snapshot.build_cost_tree(self.cubes[snapshot.year_month].cells)
+                                                        for snapshot in snapshots])
+            return
+
+        year_month = report_months[0]
+        filename = billing_zip or self.get_file_from_bucket(year_month)
+
+        cube = self.cubes[year_month]
+        if memory_budget:
+            self.load_sorted_line_items(filename, memory_budget)
+        elif self.columnar:
+            # dictionary-encoded columns instead of a list of dicts; same steps, done on codes
+            from columnar_spreadsheet import ColumnarSpreadsheet
+            daily = DailyCosts()
+            with metrics.stage('parse') as record:
+                self.spreadsheet = ColumnarSpreadsheet(self.read_line_items(filename, daily=daily))
+                record['rows'] = rows = len(self.spreadsheet)
+            with metrics.stage('fix_case', rows):
+                self.spreadsheet.fix_case()
+            with metrics.stage('sort', rows):
+                self.spreadsheet.sort_data()
+            with metrics.stage('tag_resolution', rows):
+                self.keepers = self.spreadsheet.distinct('user:KEEP')
+                self.spreadsheet.tag_past_items()
+                self.daily_costs = DailyCostMatrix.build([(daily, self.spreadsheet.resource_tag_values().get)])
+            with metrics.stage('cost_tree', rows):
+                self.cost_tree = self.spreadsheet.build_cost_tree()
+                cube.cells = self.spreadsheet.rollup_cube()
+        else:
+            self.load_line_items(filename, hourly_tags)
+            # key = keeper, value = {prod: {resource id: {'Operation': op, 'usage_types': {usage type: leaf}}}}
+            with metrics.stage('cost_tree', rows=len(self.spreadsheet)):
+                self.cost_tree = self.build_cost_tree(cube.cells)
+        cube.keepers = self.keepers
+
+    def load_line_items(self, filename, hourly_tags=False, daily_costs=True):
+        """Read the billing zip into self.spreadsheet, fix case, sort, and tag past items
+        daily_costs: also sum self.daily_costs on the way (the warehouse gets them from its own table instead).
+        """
+        self.filename = filename
+        daily = DailyCosts() if daily_costs else None
+        with metrics.stage('parse') as record:
+            # by resource until its tags are known; hourly tags differ within a resource, so those wait for them
+            self.spreadsheet = list(self.read_line_items(self.filename, daily=None if hourly_tags else daily))
+            record['rows'] = rows = len(self.spreadsheet)
+
+        with metrics.stage('fix_case', rows):
+            self.fix_case()
+        with metrics.stage('sort', rows):
+            self.sort_data()
+
+        with metrics.stage('tag_resolution', rows):
+            temp_keepers = set()
+            for row in self.spreadsheet:
+                temp_keepers.add(row['user:KEEP'])
+            self.keepers = list(temp_keepers)
+            del temp_keepers
+
+            self.resources_tag_dict = {}  # key = resource id, value = {'user:KEEP': name, 'user:PROD': yes/}
+            self.get_resource_tags(hourly=hourly_tags)  # populate above dictionary
+            self.tag_past_items(hourly=hourly_tags, daily=daily if hourly_tags else None)
+        if daily is not None and hourly_tags:
+            self.daily_costs = DailyCostMatrix.build([(daily, tags_of_tagged)])
+        elif daily is not None:
+            tags = self.resources_tag_dict
+            self.daily_costs = DailyCostMatrix.build([(daily, lambda res_id: (tags[res_id]['user:KEEP'],
+                                                                              tags[res_id]['user:PROD']))])
+
+    def load_sorted_line_items(self, filename, memory_budget):
+        """Bounded-memory load: tag the line items and sort them by SORTED_FIELDS on disk (ExternalSort), with at
+        most memory_budget MB of them in memory. The zip is parsed once: the first pass resolves every resource's
+        tags (the same way BillingSnapshot does, one line item at a time) while spilling the untagged line items
+        to a temporary file, the second pass tags them from there and sorts them. There's no cost tree; the
+        reports get one keeper's branch at a time from keeper_branches().
+        """
+        from external_sort import ExternalSort
+        self.filename = filename
+        self.spreadsheet = None
+        self.cost_tree = None
+        # on the disk the billing zip is on, rather than a /tmp that may be memory-backed
+        self.sorted_line_items = ExternalSort(memory_budget*1024*1024 // line_item_bytes,
+                                              directory=os.path.dirname(os.path.abspath(filename)))
+        atexit.register(self.sorted_line_items.close)
+        tags = BillingSnapshot(year_month)
+        daily = DailyCosts()
+        untagged = self.sorted_line_items.temporary_file("untagged")
+        with metrics.stage('parse') as record:
+            count = 0
+            for row in self.read_line_items(filename, daily=daily):
+                tags.add_tags(row, self.get_time_comparator(row))
+                untagged.write(tuple(row[field] for field in SORTED_FIELDS[2:]))
+                count += 1
+            untagged.close()
+            record['rows'] = count
+        with metrics.stage('tag_resolution', count):
+            self.keepers = list(tags.keepers)
+            resource_tags = dict((res_id, tags.resource_tags(res_id)) for res_id in tags.resources)
+            # each resource's Operation in the reports is that of its first line item in sort_data's order
+            self.operations = dict((res_id, resource['first'][2]) for res_id, resource in tags.resources.items())
+            self.daily_costs = DailyCostMatrix.build([(daily, resource_tags.get)])
+        with metrics.stage('sort', count):
+            for row in untagged:
+                self.sorted_line_items.add(resource_tags[row[0]] + row)
+            os.remove(untagged.filename)
+
+    def keeper_branches(self):
+        """(keeper, its branch of the cost tree) for every keeper in self.keepers.
+        In memory that's self.cost_tree, in keeper order. With a memory budget each branch is built from the sorted
+        line items as it is needed, in KEEP order, so only one keeper's sums are in memory at a time; the same pass
+        adds them to the month's cube, which is only complete once every branch has been handed out.
+        """
+        if self.sorted_line_items is None:
+            for keeper in self.keepers:
+                yield keeper, self.cost_tree.get(keeper, {})
+            return
+        seen = set()
+        cells = self.cubes[year_month].cells
+        for keeper, rows in groupby(self.sorted_line_items, itemgetter(0)):
+            seen.add(keeper)
+            prod_types = {}
+            for _, prod, res_id, usage_type, operation, product, zone, _, cost in rows:
+                cell = (keeper, prod, product, usage_type, zone, operation)
+                cells[cell] = cells.get(cell, 0) + cost
+                resources = prod_types.setdefault(prod, {})
+                resource = resources.get(res_id)
+                if resource is None:
+                    resource = resources[res_id] = {'Operation': self.operations[res_id], 'usage_types': {}}
+                usage = resource['usage_types'].get(usage_type)
+                if usage is None:
+                    usage = resource['usage_types'][usage_type] = {'Cost': 0, 'zones': set()}
+                usage['Cost'] += cost
+                usage['zones'].add(zone)
+            yield keeper, prod_types
+        for keeper in self.keepers:
+            if keeper not in seen:  # only had line items before they were re-tagged to another keeper
+                yield keeper, {}
+
+    @staticmethod
+    def load_partition(month):
+        """The month's BillingSnapshot from the billing store, first updated from S3 if the report there changed.
+        A month whose report is unchanged since it was stored is neither downloaded nor read again.
+        """
+        key = SpreadsheetCache.get_billing_key(month)
+        snapshot = BillingSnapshot.load(month)
+        if snapshot.source_etag == key.etag:
+            print "Billing store is up to date for " + month
+            return snapshot
+        filename = SpreadsheetCache.get_file_from_bucket(month, key)
+        snapshot = SpreadsheetCache.update_snapshot(snapshot, filename)
+        snapshot.source_etag = key.etag
+        snapshot.save()
+        return snapshot
 
-        self.resources_tag_dict = {}  # key = resource id, value = {'user:KEEP': name, 'user:PROD': yes/}
-        self.get_resource_tags()  # populate above dictionary
-        self.tag_past_items()
+    @staticmethod
+    def update_snapshot(snapshot, filename):
+        """Add the line items of filename past the snapshot's watermark to it.
+        Starts over from an empty snapshot if the report was rewritten instead of appended to.
+        """
+        try:
+            with metrics.stage('parse') as record:
+                line_items = SpreadsheetCache.read_line_items(filename, snapshot.watermark)
+                count = 0
+                for row in line_items:
+                    snapshot.add(row, SpreadsheetCache.get_time_comparator(row))
+                    count += 1
+                record['rows'] = count
+        except ValueError:
+            if not snapshot.watermark['bytes']:
+                raise
+            print "Billing report changed since the last snapshot, re-reading the whole month"
+            return SpreadsheetCache.update_snapshot(BillingSnapshot(snapshot.year_month), filename)
+        print "Added " + str(count) + " new line items to the snapshot for " + snapshot.year_month
+        return snapshot
 
-        # regions = self.get_regions()
-        # self.live_resources = []
-        # for region in regions:
-        #     self.live_resources.extend(self.get_instances(region))
-        #     self.live_resources.extend(self.get_volumes(region))
-        #     # detailed billing report from Amazon does not show snapshot or image IDs :(
+    @staticmethod
+    def merge_cost_trees(trees):
+        """Add up cost trees (of different months). A resource keeps the Operation from the first tree it's in."""
+        if len(trees) == 1:
+            return trees[0]
+        merged = {}
+        for tree in trees:
+            for keeper, prod_types in tree.items():
+                for prod_type, resources in prod_types.items():
+                    merged_resources = merged.setdefault(keeper, {}).setdefault(prod_type, {})
+                    for res_id, resource in resources.items():
+                        merged_resource = merged_resources.setdefault(res_id, {'Operation': resource['Operation'],
+                                                                               'usage_types': {}})
+                        for usage_type, usage in resource['usage_types'].items():
+                            merged_usage = merged_resource['usage_types'].setdefault(usage_type,
+                                                                                     {'Cost': 0, 'zones': set()})
+                            merged_usage['Cost'] += usage['Cost']
+                            merged_usage['zones'].update(usage['zones'])
+        return merged
 
     def data(self):
-        """Returns spreadsheet (list of dicts)"""
+        """Returns spreadsheet (list of dicts, or a ColumnarSpreadsheet that hands out dicts the same way)
+        With the warehouse, an iterator over dicts read from it; with a memory budget, over the sorted line items.
+        """
+        if self.warehouse is not None:
+            return self.warehouse.line_items(report_months)
+        if self.sorted_line_items is not None:
+            return (dict(zip(SORTED_FIELDS, row)) for row in self.sorted_line_items)
         return self.spreadsheet
 
+    def untagged_rollup(self):
+        """rollup_untagged() of the data, or the same rollup as grouped queries when there is a warehouse, or on
+        the codes of a ColumnarSpreadsheet
+        """
+        if self.warehouse is not None:
+            return self.warehouse.untagged_rollup(report_months)
+        if self.columnar:
+            return self.spreadsheet.untagged_rollup()
+        return rollup_untagged(self.data())
+
     def fix_case(self):
         # A method to operate on the spreadsheet and update the column you need uppered
         # Doesn't return anything, just fixes the spreadsheet
@@ -66,29 +381,155 @@ class SpreadsheetCache(object):
         del temp_sheet
 
     @staticmethod
-    def get_file_from_bucket():
-        """Grab today's billing report from the S3 bucket, extract into pwd, return filename
-        Eventually: Grab a different month's billing report.
-        """
+    def billing_zip_name(month):
+        """Name of the billing report zip for a month in "YYYY-MM" format"""
         prefix = "794321122735-aws-billing-detailed-line-items-with-resources-and-tags-"
-        # Select desired month using date format "YYYY-MM"
-        global year_month
-        year_month = str(datetime.date.today().isoformat()[0:7])  # get the latest report for current month
-#        year_month = "2015-10"  # or select your own month
-        csv_filename = prefix + year_month + ".csv"
-        zip_filename = csv_filename + ".zip"
-        # If local data is older than 1 day, download fresh data.
-        # mod_time = os.path.getmtime(csv_filename)
-        if not os.path.isfile(csv_filename) or datetime.date.today() - datetime.date.fromtimestamp(os.path.getmtime(csv_filename)) > datetime.timedelta(days=0):
-            conn = S3Connection(os.environ['AWS_ACCESS_KEY'], os.environ['AWS_SECRET_KEY'])
-            mybucket = conn.get_bucket('oicr.detailed.billing')
+        return prefix + month + ".csv.zip"
+
+    @staticmethod
+    def get_billing_key(month):
+        """S3 key (with ETag, Last-Modified and size from a HEAD request) of the month's billing report"""
+        zip_filename = SpreadsheetCache.billing_zip_name(month)
+        mykey = s3_connection().get_bucket(billing_bucket).get_key(zip_filename)
+        metrics.api_call('s3', billing_bucket)
+        if mykey is None:
+            raise IOError("No billing report for " + month + " in bucket " + billing_bucket)
+        return mykey
+
+    @staticmethod
+    def get_file_from_bucket(month, mykey=None):
+        """Grab the month's billing report from the S3 bucket into pwd, return the zip's filename"""
+        zip_filename = SpreadsheetCache.billing_zip_name(month)
+        if mykey is None:
+            mykey = SpreadsheetCache.get_billing_key(month)
+        # Only download if the object in S3 changed since the copy we have (ETag/Last-Modified in the manifest)
+        manifest = SpreadsheetCache.read_manifest()
+        seen = {'etag': mykey.etag, 'last_modified': mykey.last_modified, 'size': mykey.size}
+        if os.path.isfile(zip_filename) and manifest.get(zip_filename) == seen:
+            print zip_filename + " is unchanged in S3, using local copy"
+        else:
             print "Downloading " + zip_filename + "..."
-            mykey = mybucket.get_key(zip_filename)
-            mykey.get_contents_to_filename(zip_filename)
-            print "Extracting to file " + csv_filename + "..."
-            zf = zipfile.ZipFile(zip_filename)
-            zf.extractall()
-        return csv_filename
+            with metrics.stage('download') as record:
+                SpreadsheetCache.download_in_parts(mykey, zip_filename)
+                record['bytes'] = mykey.size
+            manifest[zip_filename] = seen
+            with open(download_manifest, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        return zip_filename
+
+    @staticmethod
+    def read_manifest():
+        """Dict of zip filename -> {'etag', 'last_modified', 'size'} of the object we last downloaded"""
+        if not os.path.isfile(download_manifest):
+            return {}
+        with open(download_manifest) as f:
+            return json.load(f)
+
+    @staticmethod
+    def download_in_parts(key, filename):
+        """Fetch key as parallel byte ranges into filename.part, check the parts, then move it into place.
+        Every range request carries If-Match with the ETag, so a report replaced mid-download fails instead of
+        being stitched together from two versions.
+        """
+        part_filename = filename + ".part"
+        with open(part_filename, 'wb') as f:
+            f.truncate(key.size)
+        byte_ranges = [(start, min(start + download_part_size, key.size) - 1)
+                       for start in range(0, key.size, download_part_size)]
+        local = threading.local()
+
+        def fetch(byte_range):
+            if not hasattr(local, 'key'):  # boto connections aren't thread-safe: one per worker thread
+                local.key = Key(s3_connection().get_bucket(key.bucket.name, validate=False), key.name)
+            start, end = byte_range
+            data = local.key.get_contents_as_string(headers={'Range': "bytes=%d-%d" % (start, end),
+                                                             'If-Match': key.etag})
+            metrics.api_call('s3', key.bucket.name)
+            if len(data) != end - start + 1:
+                raise IOError("Got %d bytes for range %d-%d of %s" % (len(data), start, end, key.name))
+            with open(part_filename, 'r+b') as f:
+                f.seek(start)
+                f.write(data)
+
+        pool = ThreadPool(download_workers)
+        try:
+            pool.map(fetch, byte_ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+        if os.path.getsize(part_filename) != key.size:
+            raise IOError("Downloaded " + part_filename + " is not " + str(key.size) + " bytes")
+        etag = key.etag.strip('"')
+        if '-' not in etag:  # multipart-uploaded objects don't have an MD5 for an ETag
+            md5 = hashlib.md5()
+            with open(part_filename, 'rb') as f:
+                for block in iter(lambda: f.read(1024*1024), b''):
+                    md5.update(block)
+            if md5.hexdigest() != etag:
+                raise IOError("MD5 of " + part_filename + " does not match ETag " + etag)
+        os.rename(part_filename, filename)
+
+    @staticmethod
+    def read_line_items(zip_filename, watermark=None, daily=None):
+        """Stream billable line items straight out of the billing zip, no extracted copy on disk.
+        Only the columns the reports use are kept (LINE_ITEM_FIELDS), and zero-cost or non-LineItem rows are
+        dropped before a dict is built for them.
+        watermark ({'bytes': n, 'crc': crc32} of what an earlier run read of this month's CSV) skips the first n
+        bytes: they are checksummed but not parsed, and ValueError is raised if they changed, i.e. the report was
+        rewritten rather than appended to. Once every row has been read the watermark is moved to the end of the
+        last LineItem row: the totals rows after it (InvoiceTotal, StatementTotal...) are rewritten whenever the
+        month-to-date report is, so they are re-read next time rather than checked.
+        daily: a DailyCosts to add every line item to as it goes by.
+        """
+        print "Reading line items from " + zip_filename + "..."
+        if watermark is None:
+            watermark = {'bytes': 0, 'crc': 0}
+        zf = zipfile.ZipFile(zip_filename)
+        try:
+            member = zf.open(zf.namelist()[0])
+            header_line = member.readline()
+            read_so_far = {'bytes': len(header_line), 'crc': zlib.crc32(header_line)}
+            while read_so_far['bytes'] < watermark['bytes']:
+                block = member.read(min(1024*1024, watermark['bytes'] - read_so_far['bytes']))
+                if not block:
+                    break
+                read_so_far['bytes'] += len(block)
+                read_so_far['crc'] = zlib.crc32(block, read_so_far['crc'])
+            if watermark['bytes'] and read_so_far != watermark:
+                raise ValueError(zip_filename + " no longer starts with the line items read last time")
+            end_of_line_items = read_so_far['bytes'], read_so_far['crc']
+
+            def lines():
+                for line in member:
+                    read_so_far['bytes'] += len(line)
+                    read_so_far['crc'] = zlib.crc32(line, read_so_far['crc'])
+                    yield line
+
+            header = next(csv.reader([header_line]))
+            columns = [(field, header.index(field)) for field in LINE_ITEM_FIELDS]
+            record_type = header.index('RecordType')
+            cost = header.index('Cost')
+            for row in csv.reader(lines()):
+                if not row:  # blank line, which DictReader used to skip
+                    continue
+                if row[record_type] != "LineItem":
+                    continue
+                end_of_line_items = read_so_far['bytes'], read_so_far['crc']  # csv.reader reads no further ahead
+                cost_units = parse_cost(row[cost])
+                if cost_units == 0:
+                    continue
+                row = dict((field, row[i]) for field, i in columns)
+                row['Cost'] = cost_units
+                if row['Operation'] == "" and row['UsageType'] == "":
+                    row['Operation'] = "ProductName" + row['ProductName']
+                    row['UsageType'] = "ProductName" + row['ProductName']
+                if daily is not None:
+                    daily.add(row)
+                yield row
+            watermark['bytes'], watermark['crc'] = end_of_line_items
+        finally:
+            zf.close()
 
     def sort_data(self):
         """Sort data by ResourceId, KEEP, PROD, Operation, UsageType, Cost"""
@@ -97,34 +538,52 @@ class SpreadsheetCache(object):
                                                                   'Operation', 'UsageType', 'Cost')))
         del temp_sheet
 
-    def get_resource_tags(self):
+    def get_resource_tags(self, hourly=False):
         """Modifies (populates) dict of resource_id and {KEEP-tag, PROD-tag}-pairs
         v2: Some tags changed over time for a given resource. Retain most recent tag for the dictionary.
+        v3: One pass builds the tag history (self.tag_timeline); the dictionary is its "latest" view.
+        hourly: keep the whole history, for tag_past_items(hourly=True), not just the latest tags.
+        """
+        self.tag_timeline = TagTimeline(self.spreadsheet, SpreadsheetCache.get_time_comparator, hourly)
+        self.resources_tag_dict = self.tag_timeline.latest
+
+    def tag_past_items(self, hourly=False, daily=None):
+        """Tag untagged items if they became tagged at any time in the billing record
+        hourly: use the tags in effect at each line item's own hour instead of the resource's latest tags.
+        daily: a DailyCosts to add every tagged line item to (add_tagged).
         """
-        for row in self.spreadsheet:
-            if row['ResourceId'] not in self.resources_tag_dict:
-                self.resources_tag_dict[row['ResourceId']] = {'user:KEEP': row['user:KEEP'],
-                                                              'user:PROD': row['user:PROD'],
-                                                              'age': SpreadsheetCache.get_time_comparator(row)}
-            if len(row['user:KEEP'].strip()) != 0\
-                    and SpreadsheetCache.get_time_comparator(row) > self.resources_tag_dict[row['ResourceId']]['age']:
-                self.resources_tag_dict[row['ResourceId']]['user:KEEP'] = row['user:KEEP']
-                self.resources_tag_dict[row['ResourceId']]['age'] = self.get_time_comparator(row)
-            if len(row['user:PROD'].strip()) != 0:
-                self.resources_tag_dict[row['ResourceId']]['user:PROD'] = row['user:PROD']
-
-    def tag_past_items(self):
-        """Tag untagged items if they became tagged at any time in the billing record"""
-        copy_list = list(self.spreadsheet)
-        i = -1
         print "Tagging past items"
         for row in self.spreadsheet:
-            i += 1
-            if row['ResourceId'] in self.resources_tag_dict:
-                copy_list[i]['user:KEEP'] = self.resources_tag_dict[row['ResourceId']]['user:KEEP']
-                copy_list[i]['user:PROD'] = self.resources_tag_dict[row['ResourceId']]['user:PROD']
-        self.spreadsheet = list(copy_list)
-        del copy_list
+            if hourly:
+                row['user:KEEP'], row['user:PROD'] = self.tag_timeline.tags_at(row)
+                if daily is not None:
+                    daily.add_tagged(row)
+            else:
+                tags = self.resources_tag_dict[row['ResourceId']]
+                row['user:KEEP'] = tags['user:KEEP']
+                row['user:PROD'] = tags['user:PROD']
+
+    def build_cost_tree(self, cube_cells):
+        """Group every line item by KEEP -> PROD -> ResourceId -> UsageType in a single pass.
+        Leaves hold the summed cost and the zones seen. Resources remember the Operation of their first line item,
+        which is what the per-keeper reports have always shown.
+        The same pass adds every line item to cube_cells, the RollupCube cells.
+        """
+        tree = {}
+        for row in self.spreadsheet:
+            cell = (row['user:KEEP'], row['user:PROD'], row['ProductName'], row['UsageType'], row['AvailabilityZone'],
+                    row['Operation'])
+            cube_cells[cell] = cube_cells.get(cell, 0) + row['Cost']
+            resources = tree.setdefault(row['user:KEEP'], {}).setdefault(row['user:PROD'], {})
+            resource = resources.get(row['ResourceId'])
+            if resource is None:
+                resource = resources[row['ResourceId']] = {'Operation': row['Operation'], 'usage_types': {}}
+            usage = resource['usage_types'].get(row['UsageType'])
+            if usage is None:
+                usage = resource['usage_types'][row['UsageType']] = {'Cost': 0, 'zones': set()}
+            usage['Cost'] += row['Cost']
+            usage['zones'].add(row['AvailabilityZone'])
+        return tree
 
     @staticmethod
     def get_regions():
@@ -154,13 +613,60 @@ class SpreadsheetCache(object):
             pass
         return hours
 
+    def index_live_resources(self):
+        """Hash index of the instances and volumes that exist now, in every region: key = resource id,
+        value = {'state', 'zone', 'user:KEEP', 'user:PROD'} as they are now (tags in the billing report's case).
+        Billed resources are then looked up in it one at a time (resource_status, live_resource).
+        """
+        print "Indexing live instances and volumes..."
+        with metrics.stage('live_index') as record:
+            regions = self.get_regions()
+            pool = ThreadPool(max(1, min(region_workers, len(regions))))
+            try:
+                per_region = pool.map(lambda region: self.get_instances(region) + self.get_volumes(region), regions)
+            finally:
+                pool.close()
+                pool.join()
+            index = {}
+            for resources in per_region:
+                for resource in resources:
+                    if hasattr(resource, 'placement'):  # an instance
+                        state, zone = resource.state, resource.placement
+                    else:
+                        state, zone = resource.status, resource.zone
+                    index[resource.id] = {'state': state, 'zone': zone,
+                                          'user:KEEP': resource.tags.get('KEEP', "").upper(),
+                                          'user:PROD': resource.tags.get('PROD', "").lower()}
+            record['rows'] = len(index)
+        return index
+
+    def live_resource(self, res_id):
+        """The live index's entry for a billed resource, None if it's gone, not an instance or volume, or there
+        is no index
+        """
+        if self.live_resources is None:
+            return None
+        return self.live_resources.get(res_id)
+
+    def resource_status(self, res_id):
+        """'live' or 'terminated' for a billed instance or volume; "" for anything else, or without the index.
+        The billing report doesn't show snapshot or image IDs, and other resources (buckets...) aren't listed.
+        """
+        if self.live_resources is None or not res_id.startswith(('i-', 'vol-')):
+            return ""
+        resource = self.live_resources.get(res_id)
+        if resource is None or resource['state'] in ('shutting-down', 'terminated', 'deleting'):
+            return "terminated"
+        return "live"
+
     def get_instances(self, region):
         """Return names only"""
         creds = self.credentials()
         try:
-            conn = ec2.connect_to_region(region, **creds)
+            conn = ec2_connection(region, creds)
             instances = []
             reservations = conn.get_all_reservations()
+            metrics.api_call('ec2', region)
             for reservation in reservations:
                 for instance in reservation.instances:
                     instances.append(instance)
@@ -172,8 +678,9 @@ class SpreadsheetCache(object):
         """Return names only"""
         creds = self.credentials()
         try:
-            conn = ec2.connect_to_region(region, **creds)
+            conn = ec2_connection(region, creds)
             volumes = conn.get_all_volumes()
+            metrics.api_call('ec2', region)
         except boto.exception.EC2ResponseError:
             return []
         return volumes
@@ -198,235 +705,203 @@ class SpreadsheetCache(object):
         return images
 
 
+def period_description():
+    """What the reports cover, for their title lines"""
+    if len(report_months) == 1:
+        return "the month " + report_months[0]
+    return "the months " + report_months[0] + " to " + report_months[-1]
+
+
+def period_name(months):
+    """What the files saved for these months are named after, e.g. 2015-06 or 2015-01_2015-03"""
+    return months[0] if len(months) == 1 else months[0] + "_" + months[-1]
+
+
 def print_data():
     """Dump everything to take a look"""
     with open("blob.csv", 'w') as f:
         fields = ['user:KEEP', 'ResourceId', 'Operation', 'UsageType', 'Production?', 'Cost']
         writer = csv.DictWriter(f, fieldnames=fields)
         writer.writeheader()
-        for row in SC.spreadsheet:
+        for row in SC.data():
             writer.writerow({'user:KEEP': row['user:KEEP'],
                              'ResourceId': row['ResourceId'],
                              'Operation': row['Operation'],
                              'UsageType': row['UsageType'],
                              'Production?': row['user:PROD'],
-                             'Cost': row['Cost']})
-
-
-def subtotal(line_items):
-    """ Returns subtotal for line_items.
-    Used for summing costs of this particular usage type, under this Operation, PROD-tag, KEEP-tag
-    """
-    total_cost = 0
-    for line in line_items:
-        total_cost += float(line['Cost'])
-    return total_cost
+                             'Cost': format_cost(row['Cost'])})
 
 
-def process_resource(line_items, res_id):
-    """Process all the line items with this particular resource ID"""
-    usage_types = set([x.get('UsageType') for x in line_items])
+def process_resource(sink, keeper, prod_type, res_id, resource):
+    """Write one row per usage type of this resource, from its node in SC.cost_tree"""
     cost_for_this_resource = 0
+    report_path = "reports/" + keeper + "_report.csv"
+    status = SC.resource_status(res_id)
 
-    for usage_type in usage_types:
-        usage_cost = subtotal([line_item for line_item in line_items if line_item['UsageType'] == usage_type])
-        keeper = line_items[0].get('user:KEEP')
-        if keeper == "":
-            keeper = "untagged"
-
-        # hack hack hack hack, super sneaky
-        zones_full = [item['AvailabilityZone'] for item in line_items if item['UsageType'] == usage_type]
-        zones = list(set(zones_full))
-        zones.reverse()
-        zone = zones[0]  # first: low quality pass
-
-        # status = ""
-        # if res_id in [x.id.encode() for x in SC.live_resources]:
-        #     status = "confirmed live"
-        #     if len(zone.strip()) == 0:  #if first pass bad, try here!
-        #         pdb.set_trace()
-        #         # TypeError: 'Instance' object has no attribute '__getitem__'
-        #         if 'zone' in [x for x in SC.live_resources if x['ResourceId'] == res_id][0]:
-        #             zone = [x for x in SC.live_resources if x['ResourceId'] == res_id][0]['zone']
-
-        with open("reports/" + keeper + "_report.csv", 'a') as f:
-            fields = ['user:KEEP', 'ResourceId',  # 'Status, if available',
-                      'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost']
-            writer = csv.DictWriter(f, fieldnames=fields)
-            writer.writerow({'user:KEEP': keeper, 'ResourceId': res_id,
-                             # 'Status, if available': status,
-                             'AvailabilityZone': zone,
-                             'Operation': line_items[0]['Operation'], 'UsageType': usage_type,
-                             'Production?': line_items[0]['user:PROD'], 'Cost': usage_cost})
-        cost_for_this_resource += usage_cost
+    for usage_type in sorted(resource['usage_types']):
+        usage = resource['usage_types'][usage_type]
+        zone = max(usage['zones'])  # prefer a non-blank zone if this usage type ever had one
+
+        sink.writerow(report_path, report_fields,
+                      {'user:KEEP': keeper, 'ResourceId': res_id,
+                       'Status, if available': status,
+                       'AvailabilityZone': zone,
+                       'Operation': resource['Operation'], 'UsageType': usage_type,
+                       'Production?': prod_type, 'Cost': format_cost(usage['Cost'])})
+        cost_for_this_resource += usage['Cost']
 
     return cost_for_this_resource
 
 
-def process_prod_type(line_items):
-    """Process all the line items for this particular production type"""
-    resources = set([x.get('ResourceId') for x in line_items])
+def process_prod_type(sink, keeper, prod_type, resources):
+    """Process all the resources for this particular production type"""
     cost_for_this_production_type = 0
-    for resource in resources:
-        cost_for_this_resource = process_resource([x for x in line_items if x['ResourceId'] == resource], resource)
-        keeper = line_items[0].get('user:KEEP')
-        if keeper == "":
-            keeper = "untagged"
-        with open("reports/" + keeper + "_report.csv", 'a') as f:
-            fields = ['user:KEEP', 'ResourceId',  # 'Status, if available',
-                      'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost', 'subtot', 'subval']
-            writer = csv.DictWriter(f, fieldnames=fields)
-            writer.writerow({'subtot': "Subtotal for resource " + resource, 'subval': cost_for_this_resource})
+    for resource in sorted(resources):
+        cost_for_this_resource = process_resource(sink, keeper, prod_type, resource, resources[resource])
+        sink.writerow("reports/" + keeper + "_report.csv", report_subtotal_fields,
+                      {'subtot': "Subtotal for resource " + resource, 'subval': format_cost(cost_for_this_resource)})
         cost_for_this_production_type += cost_for_this_resource
     return cost_for_this_production_type
 
 
-def generate_one_report(keeper):
-    """Output all the subtotal info for the specified keeper"""
-    line_items = [x for x in SC.spreadsheet if x['user:KEEP'] == keeper]
-
-    prod_types = set([x.get('user:PROD') for x in line_items])  # should be just "" or "yes" but just in case
+def generate_one_report(keeper, prod_types=None, sink=None):
+    """Output all the subtotal info for the specified keeper
+    prod_types is the keeper's branch of SC.cost_tree, looked up if not given.
+    Rows go through sink (a ReportSink shared between reports); without one, the report gets its own.
+    """
+    if prod_types is None:
+        prod_types = SC.cost_tree.get(keeper, {})  # should be just "" or "yes" but just in case
+    own_sink = sink is None
+    if own_sink:
+        sink = ReportSink()
 
     if keeper == "":
         keeper = "untagged"
-    report_name = keeper + "_report.csv"
+    report_path = keeper_report_path(keeper)
 
     print "Generating report for: " + keeper + "..."
 
-    with open("reports/" + report_name, 'w') as f:
-        fields = ['user:KEEP', 'ResourceId',  # 'Status, if available',
-                  'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost']
-        writer = csv.DictWriter(f, fieldnames=fields)
-        writer.writerow({})
-#        writer.writerow({'user:KEEP': "Report for " + keeper + " from start of month to " + str(datetime.date.today())})
-        writer.writerow({'user:KEEP': "Report for " + keeper + " for the month " + year_month})
-        writer.writeheader()
-
-        cost_for_keeper = {}
-        # bunch all by non-production, production, or anything else in the list
-    for prod_type in prod_types:
-        # list of all line_items with that prod type, and process them
-        cost_for_this_production_type = process_prod_type([line_item for line_item in line_items if line_item['user:PROD'] == prod_type])
-        with open("reports/" + report_name, 'a') as f:
-            fields = ['user:KEEP', 'ResourceId',  # 'Status, if available',
-                      'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost', 'subtot', 'subval']
-            writer = csv.DictWriter(f, fieldnames=fields)
-            writer.writerow({})
-            writer.writerow({'subtot': "Subtotal for [non/]production:", 'subval': cost_for_this_production_type})
-            writer.writerow({})
+    sink.writerow(report_path, report_fields, {})
+#    sink.writerow(report_path, report_fields, {'user:KEEP': "Report for " + keeper + " from start of month to " + str(datetime.date.today())})
+    sink.writerow(report_path, report_fields, {'user:KEEP': "Report for " + keeper + " for " + period_description()})
+    sink.writeheader(report_path, report_fields)
+
+    cost_for_keeper = {}
+    # bunch all by non-production, production, or anything else in the list
+    for prod_type in sorted(prod_types):
+        # all resources with that prod type, and process them
+        cost_for_this_production_type = process_prod_type(sink, keeper, prod_type, prod_types[prod_type])
+        sink.writerow(report_path, report_subtotal_fields, {})
+        sink.writerow(report_path, report_subtotal_fields,
+                      {'subtot': "Subtotal for [non/]production:",
+                       'subval': format_cost(cost_for_this_production_type)})
+        sink.writerow(report_path, report_subtotal_fields, {})
         cost_for_keeper[prod_type] = cost_for_this_production_type
 
-    # K this is ugly but figure it out later
-    with open("reports/" + report_name, 'a') as f:
-        fields = ['user:KEEP', 'ResourceId',  # 'Status, if available',
-                  'AvailabilityZone', 'Operation', 'UsageType', 'Production?', 'Cost', 'subtot', 'subval']
-        writer = csv.DictWriter(f, fieldnames=fields)
-        total_cost_for_keeper = sum(cost_for_keeper.values())
-        writer.writerow({'subtot': "TOTAL FOR " + keeper, 'subval': str(total_cost_for_keeper)})
+    total_cost_for_keeper = sum(cost_for_keeper.values())
+    sink.writerow(report_path, report_subtotal_fields,
+                  {'subtot': "TOTAL FOR " + keeper, 'subval': format_cost(total_cost_for_keeper)})
+    if own_sink:
+        sink.close()
 
     return cost_for_keeper
 
 
+def rollup_untagged(line_items):
+    """One pass over the line items, rolling up the untagged ones by ResourceId, Operation and UsageType at once.
+    Each group has its total Cost and the set of ProductNames seen in it. Also sums the volume, S3 and egress
+    subtotals.
+    """
+    rollup = {'ResourceId': {}, 'Operation': {}, 'UsageType': {},
+              'volume': 0, 's3': 0, 'usage_type_egress': 0, 'operation_egress': 0}
+    for row in line_items:
+        if len(row['user:KEEP'].strip()) != 0:
+            continue
+        cost = row['Cost']
+        for field in ('ResourceId', 'Operation', 'UsageType'):
+            group = rollup[field].get(row[field])
+            if group is None:
+                group = rollup[field][row[field]] = {'Cost': 0, 'products': set()}
+            group['Cost'] += cost
+            group['products'].add(row['ProductName'])
+        if "Volume" in row['UsageType']:
+            rollup['volume'] += cost
+        if "Amazon Simple Storage Service" in row['ProductName']:
+            rollup['s3'] += cost
+        if "Out" in row['UsageType']:
+            rollup['usage_type_egress'] += cost
+        if "Out" in row['Operation']:
+            rollup['operation_egress'] += cost
+    return rollup
+
+
+def product_label(products):
+    """expect a group is of one ProductName type, but if not, dump the list"""
+    products = sorted(products)
+    if len(products) == 1:
+        return str(products[0])
+    return str(products)
+
+
 def generate_untagged_overview():
     """Give just the right amount of detail to let us know where all the untagged resources are"""
     print "Generating untagged overview report..."
-    unkept = [x for x in SC.spreadsheet if len(x['user:KEEP'].strip()) == 0]
+    rollup = SC.untagged_rollup()
 
     with open("reports/untagged_sorted_reports.csv", 'w') as f:
 
         # costs by resource
         print " ...by resource..."
-        resource_ids = set([x.get('ResourceId') for x in unkept])
-        fields = ['ProductName', 'ResourceId',  # 'Resource Status (unknown unless available)',
-                  'Total cost for resource']
+        fields = ['ProductName', 'ResourceId', 'Resource Status (unknown unless available)', 'Current KEEP tag',
+                  'Current zone', 'Total cost for resource']
         writer = csv.DictWriter(f, fieldnames=fields)
 #        writer.writerow({'ProductName': "Untagged resources from start of month to " + str(datetime.date.today())})
-        writer.writerow({'ProductName': "Untagged resources for month " + year_month})
+        writer.writerow({'ProductName': "Untagged resources for " + period_description()})
 
         writer.writerow({})
         writer.writerow({'ProductName': "Untagged resources, grouped by resource id"})
         writer.writeheader()
         list_of_resources = []
-        for resource in resource_ids:
-            resource_total = sum([float(x['Cost']) for x in unkept if x['ResourceId'] == resource])
-
-            # expect a resource is of one ProductName type, but if not, dump the list
-            product = [x['ProductName'] for x in unkept if x['ResourceId'] == resource]
-            # This is awful
-            product = list(set(product))
-            if len(product) == 1:
-                product = str(product[0])
-            else:
-                product = str(product)
-
-            # status = ""
-            # if resource in SC.live_resources:
-            #     status = "confirmed live"
-
-            list_of_resources.append(dict(p=product, r=resource,
-                                          # s=status,
-                                          c=resource_total))
+        for resource, group in rollup['ResourceId'].items():
+            live = SC.live_resource(resource) or {}  # tagged since, maybe
+            list_of_resources.append(dict(p=product_label(group['products']), r=resource,
+                                          s=SC.resource_status(resource), k=live.get('user:KEEP', ""),
+                                          z=live.get('zone', ""), c=group['Cost']))
         list_of_resources = sorted(list_of_resources, key=itemgetter('p', 'c'), reverse=True)
         for res in list_of_resources:
             writer.writerow({'ProductName': res['p'], 'ResourceId': res['r'],
-                             # 'Resource Status (unknown unless available)': res['s'],
-                             'Total cost for resource': res['c']})
+                             'Resource Status (unknown unless available)': res['s'], 'Current KEEP tag': res['k'],
+                             'Current zone': res['z'], 'Total cost for resource': format_cost(res['c'])})
 
         # costs by operation
         print " ...by operation..."
-        operations = set([x.get('Operation') for x in unkept])
         fields = ['ProductName', 'Operation', 'Total cost for operation']
         writer = csv.DictWriter(f, fieldnames=fields)
         writer.writerow({})
         writer.writerow({})
         writer.writerow({'ProductName': "Untagged resources, costs by Operation"})
         writer.writeheader()
-        l_o_ops = []
-        for op in operations:
-            op_total = sum([float(x['Cost']) for x in unkept if x['Operation'] == op])
-
-            # Sorry this is awful
-            # expect a resource is of one ProductName type, but if not, dump the list
-            product = [x['ProductName'] for x in unkept if x['ResourceId'] == resource]
-            # This is awful
-            product = list(set(product))
-            if len(product) == 1:
-                product = str(product[0])
-            else:
-                product = str(product)
-
-            l_o_ops.append(dict(p=product, o=op, c=op_total))
+        l_o_ops = [dict(p=product_label(group['products']), o=op, c=group['Cost'])
+                   for op, group in rollup['Operation'].items()]
         l_o_ops = sorted(l_o_ops, key=itemgetter('p', 'c'), reverse=True)
         for oper in l_o_ops:
-            writer.writerow({'ProductName': oper['p'], 'Operation': oper['o'], 'Total cost for operation': oper['c']})
+            writer.writerow({'ProductName': oper['p'], 'Operation': oper['o'],
+                             'Total cost for operation': format_cost(oper['c'])})
 
         # costs by usage_type
         print " ...by usage type..."
-        usage_types = set([x.get('UsageType') for x in unkept])
         fields = ['ProductName', 'UsageType', 'Total cost for UsageType']
         writer = csv.DictWriter(f, fieldnames=fields)
         writer.writerow({})
         writer.writerow({})
         writer.writerow({'ProductName': "Untagged resources, costs by UsageType"})
         writer.writeheader()
-        l_o_uses = []
-        for usage in usage_types:
-            usage_total = sum([float(x['Cost']) for x in unkept if x['UsageType'] == usage])
-
-            # Sorry this is awful, again
-            # expect a resource is of one ProductName type, but if not, dump the list
-            product = [x['ProductName'] for x in unkept if x['ResourceId'] == resource]
-            # This is awful
-            product = list(set(product))
-            if len(product) == 1:
-                product = str(product[0])
-            else:
-                product = str(product)
-
-            l_o_uses.append(dict(p=product, u=usage, c=usage_total))
+        l_o_uses = [dict(p=product_label(group['products']), u=usage, c=group['Cost'])
+                    for usage, group in rollup['UsageType'].items()]
         l_o_uses = sorted(l_o_uses, key=itemgetter('p', 'c'), reverse=True)
         for use in l_o_uses:
-            writer.writerow({'ProductName': use['p'], 'UsageType': use['u'], 'Total cost for UsageType': use['c']})
+            writer.writerow({'ProductName': use['p'], 'UsageType': use['u'],
+                             'Total cost for UsageType': format_cost(use['c'])})
 
         # Generate subtotals for untagged: volumes, snapshots, AMIs, S3, and data egress
         writer.writerow({})
@@ -437,13 +912,13 @@ def generate_untagged_overview():
         global untagged_egress_sum
 
         # Volume usage
-        untagged_volume_sum = sum([float(x['Cost']) for x in unkept if "Volume" in x.get('UsageType')])
-        writer.writerow({'ProductName': "Untagged total for volumes", 'UsageType': untagged_volume_sum})
+        untagged_volume_sum = rollup['volume']
+        writer.writerow({'ProductName': "Untagged total for volumes", 'UsageType': format_cost(untagged_volume_sum)})
         # Snapshots... are not an item listed?
         # AMIs... aren't listed either...
         # S3
-        untagged_s3_sum = sum([float(x['Cost']) for x in unkept if "Amazon Simple Storage Service" in x.get('ProductName')])
-        writer.writerow({'ProductName': "Untagged total for S3", 'UsageType': untagged_s3_sum})
+        untagged_s3_sum = rollup['s3']
+        writer.writerow({'ProductName': "Untagged total for S3", 'UsageType': format_cost(untagged_s3_sum)})
         # Data egress: based on billing report of Nov 1, any outbound data is identified by:
         #   containing "Out" in the UsageType (ItemDescription confirms outbound data is being charged)
         #  XOR
@@ -452,69 +927,259 @@ def generate_untagged_overview():
         #  Nearly no lines without "Out" in one of the two fields where ItemDescription refers to outbound data
         #    ^- exception is some PUT / uploads from S3; however, it does include some other S3 transfer operations
 
-        usage_type_egress = sum([float(x['Cost']) for x in unkept if "Out" in x.get('UsageType')])
-        operation_egress = sum([float(x['Cost']) for x in unkept if "Out" in x.get('Operation')])
-        untagged_egress_sum = usage_type_egress + operation_egress
+        untagged_egress_sum = rollup['usage_type_egress'] + rollup['operation_egress']
         writer.writerow({'ProductName': "Untagged total for data egress (some overlap with S3)",
-                         'UsageType': untagged_egress_sum})
-
-
-def generate_reports():
-    """Make reports for list of keepers:
-    - individual reports with every line item,
-    - one report summarizing tagged,
-    - one report summarizing all untagged
+                         'UsageType': format_cost(untagged_egress_sum)})
+
+
+def generate_daily_trend():
+    """Cost per day of every keeper, PROD and product with any cost, then the keeper's total, from SC.daily_costs"""
+    print "Generating daily trend report..."
+    matrix = SC.daily_costs
+    with open(daily_trend_output_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user:KEEP', 'Production?', 'ProductName'] + matrix.axes[3] + ['total'])
+        for keeper in matrix.axes[0]:
+            for prod in matrix.axes[1]:
+                for product in matrix.axes[2]:
+                    series = matrix.series(keeper, prod, product)
+                    if any(series):
+                        writer.writerow([keeper or "untagged", prod, product] + [format_cost(c) for c in series] +
+                                        [format_cost(sum(series))])
+            series = matrix.series(keeper)
+            writer.writerow(["TOTAL FOR " + (keeper or "untagged"), "", ""] + [format_cost(c) for c in series] +
+                            [format_cost(sum(series))])
+
+
+def generate_daily_spikes():
+    """Days on which a keeper's cost jumped from the day before (see spike_ratio and spike_minimum)"""
+    print "Generating daily spikes report..."
+    matrix = SC.daily_costs
+    days = matrix.axes[3]
+    with open(daily_spikes_output_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user:KEEP', 'day', 'cost the day before', 'cost', 'increase', 'times the day before'])
+        for keeper in matrix.axes[0]:
+            series = matrix.series(keeper)
+            for day in range(1, len(days)):
+                before, cost = series[day - 1], series[day]
+                if cost - before >= spike_minimum and cost >= spike_ratio*before:
+                    writer.writerow([keeper or "untagged", days[day], format_cost(before), format_cost(cost),
+                                     format_cost(cost - before), "%.1f" % (float(cost)/before) if before else ""])
+
+
+def generate_summary(costs_for_keepers):
+    """Summary report: non-production, production and total cost of each keeper, from costs_for_keepers
+    ([{prod: cost, 'user:KEEP': name}] in the order to list them), with the untagged subtotals under "untagged"
     """
-    costs_for_keepers = []
-
-    # Individual full reports
-    for keeper in SC.keepers:
-        cost_for_keeper = generate_one_report(keeper)
-        if keeper == '':
-            keeper = 'untagged'  # may want to set this earlier
-        cost_for_keeper['user:KEEP'] = keeper
-        costs_for_keepers.append(cost_for_keeper)
-
-    # Overview of untagged resources
-    generate_untagged_overview()
-
-    # Summarize
     print "Generating summary report..."
     with open('reports/overall_keep+prod_summary.csv', 'w') as f:
         fields = ['user:KEEP', 'non-production subtotal', 'production subtotal', 'user total']
         writer = csv.DictWriter(f, fieldnames=fields)
 #        writer.writerow({'user:KEEP': "Summary of costs from start of month to " + str(datetime.date.today())})
-        writer.writerow({'user:KEEP': "Summary of costs for month " + year_month})
+        writer.writerow({'user:KEEP': "Summary of costs for " + period_description()})
         writer.writeheader()
         writer.writerow({})
-        for i in range(len(SC.keepers)):
+        for i in range(len(costs_for_keepers)):
             # ok this is not robust at all, TODO: robustify
             if 'yes' not in costs_for_keepers[i]:
                 costs_for_keepers[i]['yes'] = 0
             if '' not in costs_for_keepers[i]:
                 costs_for_keepers[i][''] = 0
-            total = float(costs_for_keepers[i]['']) + float(costs_for_keepers[i]['yes'])
+            total = costs_for_keepers[i][''] + costs_for_keepers[i]['yes']
             writer.writerow({'user:KEEP': costs_for_keepers[i]['user:KEEP'],
-                             'non-production subtotal': costs_for_keepers[i][''],
-                             'production subtotal': costs_for_keepers[i]['yes'],
-                             'user total': total})
+                             'non-production subtotal': format_cost(costs_for_keepers[i]['']),
+                             'production subtotal': format_cost(costs_for_keepers[i]['yes']),
+                             'user total': format_cost(total)})
             # extra subtotals for breakdown of untagged costs
             if costs_for_keepers[i]['user:KEEP'] is 'untagged':
-                writer.writerow({'user:KEEP': " untagged subtotal for volume usage", 'user total': untagged_volume_sum})
-                writer.writerow({'user:KEEP': " untagged subtotal for S3", 'user total': untagged_s3_sum})
+                writer.writerow({'user:KEEP': " untagged subtotal for volume usage",
+                                 'user total': format_cost(untagged_volume_sum)})
+                writer.writerow({'user:KEEP': " untagged subtotal for S3",
+                                 'user total': format_cost(untagged_s3_sum)})
                 writer.writerow({'user:KEEP': " untagged subtotal for data egress (some overlap with S3)",
-                                 'user total': untagged_egress_sum})
+                                 'user total': format_cost(untagged_egress_sum)})
+
+
+def generate_one_report_in_worker(keeper_and_prod_types):
+    """Pool.map only passes one argument. Returns (keeper, cost for keeper)."""
+    return keeper_and_prod_types[0], generate_one_report(*keeper_and_prod_types)
+
 
+def keeper_report_path(keeper):
+    return "reports/" + (keeper or "untagged") + "_report.csv"
 
-def main():
+
+def generate_reports(workers=1, report_done=None):
+    """Make reports for list of keepers:
+    - individual reports with every line item,
+    - one report summarizing tagged,
+    - one report summarizing all untagged
+    The individual reports are written from SC.keeper_branches(), one keeper's branch of the cost tree at a time.
+    With workers > 1 they are written by a pool of that many processes, each handed only its keeper's branch.
+    Results come back in the order of the branches, so the output is the same as serial.
+    report_done(path), if given, is called as soon as each report file is complete, e.g. to start uploading it.
+    """
+    costs_for_keepers = []
+    if report_done is None:
+        report_done = lambda path: None
+
+    # Individual full reports
+    keeper_costs = {}
+    with metrics.stage('keeper_reports') as record:
+        record['rows'] = 0
+
+        def branches():
+            for keeper, prod_types in SC.keeper_branches():
+                record['rows'] += sum(len(resource['usage_types']) for resources in prod_types.values()
+                                      for resource in resources.values())
+                yield keeper, prod_types
+
+        if workers > 1:
+            pool = Pool(workers)
+            try:
+                for keeper, cost_for_keeper in pool.imap(generate_one_report_in_worker, branches()):
+                    keeper_costs[keeper] = cost_for_keeper
+                    report_done(keeper_report_path(keeper))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            sink = ReportSink()
+            try:
+                for keeper, prod_types in branches():
+                    keeper_costs[keeper] = generate_one_report(keeper, prod_types, sink)
+                    sink.close(keeper_report_path(keeper))
+                    report_done(keeper_report_path(keeper))
+            finally:
+                sink.close()
+
+    for keeper in SC.keepers:
+        cost_for_keeper = keeper_costs[keeper]
+        if keeper == '':
+            keeper = 'untagged'  # may want to set this earlier
+        cost_for_keeper['user:KEEP'] = keeper
+        costs_for_keepers.append(cost_for_keeper)
+
+    # Overview of untagged resources
+    with metrics.stage('untagged_overview'):
+        generate_untagged_overview()
+    report_done("reports/untagged_sorted_reports.csv")
+
+    # Summarize
+    with metrics.stage('summary', rows=len(SC.keepers)):
+        generate_summary(costs_for_keepers)
+    report_done('reports/overall_keep+prod_summary.csv')
+
+    # Everything the summary was made from, and more, for re-cutting the numbers later with rollup.py, a cube per
+    # month so that any range of months is the sum of theirs
+    with metrics.stage('rollup_cube') as record:
+        for month in report_months:
+            SC.cubes[month].save(rollup_cube_filename_format % month)
+        record['rows'] = sum(len(cube.cells) for cube in SC.cubes.values())
+
+    # Cost per day, collected by the backend while reading the line items
+    with metrics.stage('daily_trend'):
+        SC.daily_costs.save(daily_costs_filename_format % period_name(report_months))
+        generate_daily_trend()
+        generate_daily_spikes()
+    report_done(daily_trend_output_file)
+    report_done(daily_spikes_output_file)
+
+
+def main(workers=1, report_done=None):
     # print_data()  # prints blob of data
     # import pdb; pdb.set_trace()
     # generate_one_report('ADAM')
     # generate_one_report('BRIAN')
     # generate_one_report('DENIS')
 
-    generate_reports()
+    generate_reports(workers, report_done)
+
+
+def add_arguments(parser):
+    """The cost report options, on this script's parser or pipeline.py's (see check_args)"""
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--columnar', action='store_true',
+                         help="keep line items in dictionary-encoded numpy columns (needs numpy, uses less memory)")
+    backend.add_argument('--incremental', action='store_true',
+                         help="only parse line items added since the last run, using the saved snapshot for the month")
+    backend.add_argument('--warehouse', action='store_true',
+                         help="load line items into a local SQLite database (once per month) and report from queries")
+    backend.add_argument('--memory-budget', type=int, metavar='MB',
+                         help="hold at most this many MB of line items in memory, sorting the rest on disk")
+    parser.add_argument('--hourly-tags', action='store_true',
+                        help="attribute each line item to the KEEP/PROD tags in effect at its hour, not the resource's "
+                             "latest tags (not with --columnar or --incremental)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes writing the per-keeper reports (default 1, i.e. serial)")
+    parser.add_argument('--live-status', action='store_true',
+                        help="mark each billed instance and volume live or terminated, from the EC2 API")
+    parser.add_argument('--month', type=month_arg, help="report on this month (YYYY-MM) instead of the current one")
+    parser.add_argument('--from', dest='from_month', type=month_arg,
+                        help="report on every month from this one (YYYY-MM), e.g. a quarter or year to date")
+    parser.add_argument('--to', dest='to_month', type=month_arg,
+                        help="last month of a --from range (YYYY-MM, default the current month)")
+
+
+def check_args(parser, args):
+    """Reject combinations of add_arguments' options that don't work together, and set args.months"""
+    if args.month and (args.from_month or args.to_month):
+        parser.error("use either --month or --from/--to")
+    if args.to_month and not args.from_month:
+        parser.error("--to needs --from")
+    args.months = None
+    if args.month:
+        args.months = [args.month]
+    elif args.from_month:
+        args.months = months_between(args.from_month, args.to_month or datetime.date.today().isoformat()[0:7])
+        if not args.months:
+            parser.error("--from is after --to")
+    multiple_months = args.months and len(args.months) > 1
+    if args.hourly_tags and (args.columnar or args.incremental or args.memory_budget or
+                             (multiple_months and not args.warehouse)):
+        parser.error("--hourly-tags needs every line item, so it can't be combined with --columnar, --incremental, "
+                     "--memory-budget or a range of months (except with --warehouse)")
+    if (args.columnar or args.memory_budget) and multiple_months:
+        parser.error("a range of months is read from the billing store, it can't be combined with --columnar or "
+                     "--memory-budget")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cost reports from this month's detailed billing report")
+    add_arguments(parser)
+    parser.add_argument('--profile', metavar='STAGE',
+                        help="run this stage (e.g. parse, sort, keeper_reports) under cProfile, see run_metrics.py")
+    args = parser.parse_args()
+    check_args(parser, args)
+    return args
+
+
+def month_arg(value):
+    """argparse type for "YYYY-MM" """
+    try:
+        datetime.datetime.strptime(value, "%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a month as YYYY-MM, got " + value)
+    return value
+
+
+def months_between(first, last):
+    """All months from first to last inclusive, as "YYYY-MM" strings"""
+    year, month = int(first[0:4]), int(first[5:7])
+    months = []
+    while "%04d-%02d" % (year, month) <= last:
+        months.append("%04d-%02d" % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
 
 if __name__ == '__main__':
-    SC = SpreadsheetCache()
-    main()
+    args = parse_args()
+    metrics.profile_stage = args.profile
+    try:
+        SC = SpreadsheetCache(columnar=args.columnar, incremental=args.incremental, hourly_tags=args.hourly_tags,
+                              months=args.months, warehouse=args.warehouse, memory_budget=args.memory_budget,
+                              live_status=args.live_status)
+        main(args.workers)
+    finally:
+        metrics.save('cost_reporting_data')
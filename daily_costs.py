@@ -0,0 +1,99 @@
+# Cost per keeper, PROD, product and day, to see when spend changed rather than only the month's total.
+# The sums are collected while the billing report is read, by resource (DailyCosts), since a resource's tags are
+# only final once the whole month has been seen; they are then folded into a dense keeper x PROD x product x day
+# matrix (DailyCostMatrix) that the daily trend and the day-over-day spikes are written from. Where every line item
+# already carries its final tags (hourly tagging, the billing warehouse) they are summed by (KEEP, PROD) instead.
+
+from array import array
+import cPickle
+import os
+
+
+class DailyCosts(object):
+    """Line item costs summed by (ResourceId, ProductName, day), one line item at a time, or by ((KEEP, PROD),
+    ProductName, day) once the line items are tagged (add_tagged; build the matrix with tags_of_tagged)
+    """
+    def __init__(self):
+        self.costs = {}
+
+    def add(self, row):
+        key = (row['ResourceId'], row['ProductName'], row['UsageStartDate'][0:10])
+        self.costs[key] = self.costs.get(key, 0) + row['Cost']
+
+    def add_tagged(self, row):
+        key = ((row['user:KEEP'], row['user:PROD']), row['ProductName'], row['UsageStartDate'][0:10])
+        self.costs[key] = self.costs.get(key, 0) + row['Cost']
+
+
+def tags_of_tagged(tags):
+    """DailyCostMatrix.build tags for a DailyCosts filled by add_tagged: the key already is (KEEP, PROD)"""
+    return tags
+
+
+class DailyCostMatrix(object):
+    """Costs in a flat array of 64-bit cost units (cost_reporting_data.cost_scale), indexed by keeper, PROD,
+    product and day, each axis sorted
+    """
+    def __init__(self, keepers, prods, products, days):
+        self.axes = [sorted(keepers), sorted(prods), sorted(products), sorted(days)]
+        self.positions = [dict((value, i) for i, value in enumerate(axis)) for axis in self.axes]
+        size = 1
+        for axis in self.axes:
+            size *= len(axis)
+        self.costs = array('l', [0])*size  # 'l' is 64 bits on Linux, enough for any month in cost units
+
+    @staticmethod
+    def build(sources):
+        """Matrix of [(DailyCosts, tags)], tags: resource id -> (KEEP, PROD) the reports charge it to"""
+        axes = [set(), set(), set(), set()]
+        for daily, tags in sources:
+            for (res_id, product, day) in daily.costs:
+                keeper, prod = tags(res_id)
+                for axis, value in zip(axes, (keeper, prod, product, day)):
+                    axis.add(value)
+        matrix = DailyCostMatrix(*axes)
+        for daily, tags in sources:
+            for (res_id, product, day), cost in daily.costs.items():
+                keeper, prod = tags(res_id)
+                matrix.costs[matrix.offset(keeper, prod, product, day)] += cost
+        return matrix
+
+    def offset(self, keeper, prod, product, day):
+        offset = 0
+        for axis, positions, value in zip(self.axes, self.positions, (keeper, prod, product, day)):
+            offset = offset*len(axis) + positions[value]
+        return offset
+
+    def series(self, keeper, prod=None, product=None):
+        """Cost per day (in self.axes[3] order) of a keeper, or one PROD/product of it"""
+        days = len(self.axes[3])
+        totals = [0]*days
+        if not days:
+            return totals
+        for prod_value in self.axes[1]:
+            if prod is not None and prod_value != prod:
+                continue
+            for product_value in self.axes[2]:
+                if product is not None and product_value != product:
+                    continue
+                start = self.offset(keeper, prod_value, product_value, self.axes[3][0])
+                for day, cost in enumerate(self.costs[start:start + days]):
+                    totals[day] += cost
+        return totals
+
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filename + ".tmp", 'wb') as f:
+            cPickle.dump({'axes': self.axes, 'costs': self.costs.tostring()}, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename + ".tmp", filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            saved = cPickle.load(f)
+        matrix = DailyCostMatrix(*saved['axes'])
+        matrix.costs = array('l', saved['costs'])
+        return matrix
+
@@ -0,0 +1,83 @@
+# Sorting more line items than fit in memory: they are gathered in a buffer of at most budget_rows, which is sorted
+# and spilled to a temporary file (a run) whenever it fills up, and the runs are merged back into one sorted stream.
+# Memory is the buffer while sorting, and one batch per run while merging, whatever the size of the month.
+
+import cPickle
+import heapq
+import os
+import shutil
+import tempfile
+
+batch_rows = 1000  # rows pickled together in a run file; merging holds one batch of each run in memory
+
+
+class RunFile(object):
+    """Rows (tuples) written to a file in pickled batches and read back in the same order"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'wb')
+        self.batch = []
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= batch_rows:
+            cPickle.dump(self.batch, self.f, cPickle.HIGHEST_PROTOCOL)
+            self.batch = []
+
+    def close(self):
+        if self.batch:
+            cPickle.dump(self.batch, self.f, cPickle.HIGHEST_PROTOCOL)
+            self.batch = []
+        self.f.close()
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as f:
+            while True:
+                try:
+                    batch = cPickle.load(f)
+                except EOFError:
+                    return
+                for row in batch:
+                    yield row
+
+
+class ExternalSort(object):
+    """Sorts tuples with at most budget_rows of them in memory. add() them all, then iterate (as often as needed)
+    for the merged, sorted stream. close() removes the temporary files.
+    """
+    def __init__(self, budget_rows, directory=None):
+        self.budget_rows = max(batch_rows, budget_rows)
+        self.directory = tempfile.mkdtemp(prefix="external_sort_", dir=directory)
+        self.buffer = []
+        self.runs = []
+
+    def temporary_file(self, name):
+        """A RunFile in this sort's directory, for anything else that needs spilling (e.g. unsorted input)"""
+        return RunFile(os.path.join(self.directory, name))
+
+    def add(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.budget_rows:
+            self.spill()
+
+    def spill(self):
+        run = self.temporary_file("run%d" % len(self.runs))
+        self.buffer.sort()
+        for row in self.buffer:
+            run.write(row)
+        run.close()
+        self.runs.append(run)
+        self.buffer = []
+
+    def __iter__(self):
+        if self.buffer and self.runs:
+            self.spill()  # whatever is left joins the merge as one more run, instead of staying in memory
+        if not self.runs:
+            self.buffer.sort()
+            return iter(self.buffer)
+        return heapq.merge(*self.runs)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.buffer = []
+        self.runs = []
@@ -0,0 +1,78 @@
+# The inventory usage_data.py saw on its last run, one table of report rows per resource type.
+# A resource type fetched less than its TTL ago is taken from here instead of enumerating every region again,
+# and comparing a run's tables with these is what says which resources were created, deleted or retagged,
+# and which reports have to be written again.
+
+import cPickle
+import os
+import time
+
+inventory_cache_filename = "inventory_cache.pickle"
+inventory_cache_version = 2  # bump when the stored rows change meaning; older caches are ignored
+
+RESOURCE_TYPES = ['instance', 'volume', 'snapshot', 'image']
+TAG_FIELDS = ['KEEP_tag', 'PROD_tag', 'Name_tag']  # a change in any of these is a retag
+
+
+class InventoryCache(object):
+    def __init__(self):
+        self.version = inventory_cache_version
+        # key = resource type, value = {'fetched': unix time, 'selection': how it was listed (filters, owner),
+        #                               'rows': {resource id: report row}}
+        self.tables = {}
+
+    @staticmethod
+    def load():
+        """Cache saved by the last run, or an empty one"""
+        if not os.path.isfile(inventory_cache_filename):
+            return InventoryCache()
+        with open(inventory_cache_filename, 'rb') as f:
+            cache = cPickle.load(f)
+        if getattr(cache, 'version', None) != inventory_cache_version:
+            return InventoryCache()
+        return cache
+
+    def save(self):
+        with open(inventory_cache_filename + ".tmp", 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(inventory_cache_filename + ".tmp", inventory_cache_filename)
+
+    def is_fresh(self, res_type, ttl, selection):
+        """Was this resource type fetched less than ttl seconds ago, with the same filters?"""
+        table = self.tables.get(res_type)
+        return table is not None and table['selection'] == selection and time.time() - table['fetched'] < ttl
+
+    def rows(self, res_type):
+        """Copy of the stored rows, safe to modify"""
+        table = self.tables.get(res_type, {'rows': {}})
+        return dict((res_id, dict(row)) for res_id, row in table['rows'].items())
+
+    def store(self, res_type, rows, selection, fetched=None):
+        """Replace a resource type's rows. fetched: when they were fetched, default the time they were last
+        fetched (for rows taken from the cache and only re-linked)
+        """
+        if fetched is None:
+            fetched = self.tables[res_type]['fetched']
+        self.tables[res_type] = {'fetched': fetched, 'selection': selection,
+                                 'rows': dict((res_id, dict(row)) for res_id, row in rows.items())}
+
+
+def diff_tables(res_type, old_rows, new_rows):
+    """(change, resource type, id, region, old tags, new tags) for every resource created, deleted or retagged
+    between two tables of the same resource type, in id order
+    """
+    changes = []
+    for res_id in sorted(set(old_rows) | set(new_rows)):
+        old = old_rows.get(res_id)
+        new = new_rows.get(res_id)
+        if old is None:
+            changes.append(('created', res_type, res_id, new['region'], None, tags_of(new)))
+        elif new is None:
+            changes.append(('deleted', res_type, res_id, old['region'], tags_of(old), None))
+        elif tags_of(old) != tags_of(new):
+            changes.append(('retagged', res_type, res_id, new['region'], tags_of(old), tags_of(new)))
+    return changes
+
+
+def tags_of(row):
+    return dict((field, row[field]) for field in TAG_FIELDS)
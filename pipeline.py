@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# The nightly reporting run in one process, in place of report_runner.sh starting usage_data.py,
+# cost_reporting_data.py and reports_to_bucket.py one after the other.
+# The inventory stage (mostly waiting on the EC2 API) and the billing stage (mostly parsing and summing) run at the
+# same time, and every report is handed to the uploader as soon as its file is complete, so uploads overlap with
+# the reports still being written.
+
+import argparse
+import os
+import sys
+import threading
+import time
+import traceback
+
+import cost_reporting_data
+import reports_to_bucket
+import usage_data
+from run_metrics import metrics
+
+
+def run_stages(stages):
+    """Run stages, [(name, function, [names of the stages it needs])], each in its own thread as soon as the stages
+    it needs are done. A stage that needs a failed stage doesn't run.
+    Returns {name: wall-clock seconds} of the stages that ran and {name: what went wrong} of the ones that failed
+    or didn't run.
+    """
+    done = dict((name, threading.Event()) for name, _, _ in stages)
+    timings = {}
+    errors = {}
+
+    def run(name, function, needs):
+        try:
+            for need in needs:
+                done[need].wait()
+            failed = [need for need in needs if need in errors]
+            if failed:
+                errors[name] = "not run, " + ", ".join(failed) + " failed"
+                return
+            start = time.time()
+            try:
+                with metrics.stage(name):
+                    function()
+            except Exception as e:
+                traceback.print_exc()
+                errors[name] = repr(e)
+            finally:
+                timings[name] = time.time() - start
+        finally:
+            done[name].set()
+
+    threads = [threading.Thread(target=run, args=stage, name=stage[0]) for stage in stages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, errors
+
+
+def parse_args():
+    """Every option of cost_reporting_data.py and usage_data.py, the same as when they are run on their own, plus
+    the uploader's
+    """
+    parser = argparse.ArgumentParser(description="Inventory and cost reports, generated and uploaded in one run")
+    cost_reporting_data.add_arguments(parser)
+    usage_data.add_arguments(parser)
+    parser.add_argument('--upload-workers', type=int, default=reports_to_bucket.upload_workers,
+                        help="reports uploaded at the same time (default %d)" % reports_to_bucket.upload_workers)
+    parser.add_argument('--gzip', action='store_true', help="upload the reports gzipped")
+    parser.add_argument('--no-upload', action='store_true', help="only write the reports")
+    parser.add_argument('--profile', metavar='STAGE',
+                        help="run this stage (e.g. billing, parse, inventory_fetch) under cProfile, see run_metrics.py")
+    args = parser.parse_args()
+    cost_reporting_data.check_args(parser, args)
+    usage_data.check_args(args)
+    return args
+
+
+def main(args):
+    for variable in ['AWS_ACCESS_KEY', 'AWS_SECRET_KEY']:  # every stage needs them, so check once up front
+        if not os.environ.get(variable):
+            sys.exit("The environment variables AWS_ACCESS_KEY and AWS_SECRET_KEY need to be defined")
+
+    stages = []  # (name, function, [names of the stages it needs])
+    report_done = None
+    timings = {}
+    if not args.no_upload:
+        start = time.time()
+        uploader = reports_to_bucket.ReportUploader(compress=args.gzip, workers=args.upload_workers)
+        timings['upload listing'] = time.time() - start
+
+        def report_done(path):
+            uploader.submit(os.path.relpath(path, reports_to_bucket.reports_directory))
+
+    def inventory():
+        usage_data.page_size = args.page_size
+        usage_data.main(usage_data.InventorySnapshot(workers=args.region_workers, ttl=args.ttl, refresh=args.refresh,
+                                                     filters=args.filters, owner=args.owner), report_done)
+
+    def billing():
+        cost_reporting_data.SC = cost_reporting_data.SpreadsheetCache(
+            columnar=args.columnar, incremental=args.incremental, hourly_tags=args.hourly_tags, months=args.months,
+            warehouse=args.warehouse, memory_budget=args.memory_budget, live_status=args.live_status)
+        cost_reporting_data.main(args.workers, report_done)
+
+    stages.append(('inventory', inventory, []))
+    stages.append(('billing', billing, []))
+
+    start = time.time()
+    stage_timings, errors = run_stages(stages)
+    timings.update(stage_timings)
+    if not args.no_upload:
+        # the reports have been uploading all along, this waits for the last of them. Whatever was written before
+        # a stage failed still goes up, as it did when report_runner.sh ran reports_to_bucket.py regardless.
+        upload_start = time.time()
+        try:
+            results = uploader.close()
+            print ", ".join(str(results.values().count(result)) + " " + result
+                            for result in ['uploaded', 'copied', 'unchanged'])
+        except Exception as e:
+            traceback.print_exc()
+            errors['upload'] = repr(e)
+        timings['upload wait'] = time.time() - upload_start
+    timings['total'] = time.time() - start + timings.get('upload listing', 0)
+
+    print "Stage timings (wall clock):"
+    for name in ['upload listing', 'inventory', 'billing', 'upload wait', 'total']:
+        if name in timings:
+            print "  %-15s %8.1fs" % (name, timings[name])
+    for name in sorted(errors):
+        print "  %-15s %s" % (name, errors[name])
+    metrics.save('pipeline')
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics.profile_stage = args.profile
+    sys.exit(main(args))
@@ -1,6 +1,5 @@
 #!/bin/bash
 
-python usage_data.py 1> usage_stdout.txt
-python cost_reporting_data.py 1> cost_reporting_stdout.txt
-python reports_to_bucket.py
+# inventory, cost reports and upload in one process; see pipeline.py
+python pipeline.py 1> pipeline_stdout.txt
 echo "Reporting scripts done."
@@ -0,0 +1,48 @@
+# Buffered CSV output for the report files.
+# Report rows used to be written by reopening the file in append mode and building a new csv.DictWriter per row.
+# A ReportSink keeps one buffered writer per file instead, and only closes files when too many are open.
+
+from collections import OrderedDict
+import csv
+
+
+class ReportSink(object):
+    """Write rows to any number of CSV files through buffered writers that stay open between rows.
+    At most max_open files are open at a time: the least recently written one is flushed and closed to make room,
+    and reopened in append mode if it gets more rows. The first write to a file in a sink's lifetime truncates it.
+    Rows come out exactly as csv.DictWriter(f, fieldnames=fields).writerow(row) would write them.
+    """
+    def __init__(self, max_open=32, buffer_size=1024*1024):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.open_files = OrderedDict()  # key = path, value = (file, csv writer), least recently used first
+        self.started = set()  # paths written to at some point, so reopening appends instead of truncating
+
+    def writer(self, path):
+        if path in self.open_files:
+            f, writer = self.open_files.pop(path)
+        else:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1][0].close()
+            f = open(path, 'a' if path in self.started else 'w', self.buffer_size)
+            writer = csv.writer(f)
+            self.started.add(path)
+        self.open_files[path] = (f, writer)
+        return writer
+
+    def writerow(self, path, fields, row):
+        """Same as csv.DictWriter.writerow: missing fields are blank, unknown ones are an error"""
+        wrong_fields = [k for k in row if k not in fields]
+        if wrong_fields:
+            raise ValueError("dict contains fields not in fieldnames: " + ", ".join(wrong_fields))
+        self.writer(path).writerow([row.get(field, "") for field in fields])
+
+    def writeheader(self, path, fields):
+        self.writer(path).writerow(fields)
+
+    def close(self, path=None):
+        """Flush and close one file, or all of them"""
+        paths = [path] if path is not None else list(self.open_files)
+        for p in paths:
+            if p in self.open_files:
+                self.open_files.pop(p)[0].close()
@@ -1,24 +1,180 @@
 #!/usr/bin/python
 __author__ = 'cleung'
-import boto
+import argparse
 import datetime
+import gzip
+import hashlib
 import os
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
-# Filenames of reports to be uploaded
-reports = []
-for root, dirs, files in os.walk('reports/'):
-    reports.extend(files)
+from connections import billing_bucket, s3_connection
+from run_metrics import metrics
 
-s3_connect = boto.connect_s3(os.environ['AWS_ACCESS_KEY'], os.environ['AWS_SECRET_KEY'])
+reports_directory = "reports/"
+upload_workers = 8  # files uploaded at the same time
+multipart_threshold = 64*1024*1024  # files at least this big go up as a multipart upload
+multipart_part_size = 16*1024*1024  # bytes per part (S3's minimum is 5MB)
 
-dst_bucket = s3_connect.get_bucket("oicr.detailed.billing")
-my_key = boto.s3.key.Key(dst_bucket)
 
-def upload_one_file(report):
-    my_key.key = "reports/" + str(datetime.date.today()) + "_" + report
-    my_key.set_contents_from_filename("reports/" + report)
+def report_files():
+    """Filenames of reports to be uploaded"""
+    reports = []
+    for root, dirs, files in os.walk(reports_directory):
+        reports.extend(files)
+    return sorted(reports)
 
-for i, report in enumerate(reports):
-    print str(i+1) + "/" + str(len(reports)) + \
-          ") Uploading " + report + " to S3 bucket 'oicr.detailed.billing'..."
-    upload_one_file(report)
+
+def key_name(report, date):
+    return "reports/" + date + "_" + report
+
+
+def latest_uploads(bucket, today):
+    """key = report filename, value = the Key of its most recent upload up to today, from one listing"""
+    latest = {}
+    listed = 0
+    for key in bucket.list(prefix="reports/"):
+        date, _, report = key.name[len("reports/"):].partition('_')
+        if date <= today and (report not in latest or latest[report].name < key.name):
+            latest[report] = key
+        listed += 1
+    metrics.api_call('s3', bucket.name, listed//1000 + 1)  # keys come 1000 to a request
+    return latest
+
+
+def prepare(report, compress):
+    """(file, size, etags) of what goes to S3 for this report: the file itself, or a gzip of it in a temporary file.
+    etags: the ETags S3 would give it, uploaded in one piece or in multipart_part_size parts.
+    """
+    f = open(reports_directory + report, 'rb')
+    if compress:
+        compressed = tempfile.TemporaryFile()
+        with f:
+            # no name or time in the header, so the same report always compresses to the same bytes (and ETag)
+            gz = gzip.GzipFile(filename='', mode='wb', fileobj=compressed, mtime=0)
+            for block in iter(lambda: f.read(1024*1024), b''):
+                gz.write(block)
+            gz.close()
+        f = compressed
+        f.seek(0)
+
+    md5 = hashlib.md5()
+    part_digests = []
+    size = 0
+    for part in iter(lambda: f.read(multipart_part_size), b''):
+        md5.update(part)
+        part_digests.append(hashlib.md5(part).digest())
+        size += len(part)
+    f.seek(0)
+    etags = set([md5.hexdigest()])
+    if size >= multipart_threshold:
+        etags.add(hashlib.md5(b''.join(part_digests)).hexdigest() + "-" + str(len(part_digests)))
+    return f, size, etags
+
+
+def upload(bucket, name, f, size, headers):
+    if size < multipart_threshold:
+        key = bucket.new_key(name)
+        key.set_contents_from_file(f, headers=headers)
+        metrics.api_call('s3', bucket.name)
+        return
+    multipart = bucket.initiate_multipart_upload(name, headers=headers)
+    try:
+        for part_num, start in enumerate(range(0, size, multipart_part_size)):
+            f.seek(start)
+            multipart.upload_part_from_file(f, part_num + 1, size=min(multipart_part_size, size - start))
+        multipart.complete_upload()
+        metrics.api_call('s3', bucket.name, part_num + 3)  # initiate, the parts, complete
+    except:
+        multipart.cancel_upload()
+        raise
+
+
+class ReportUploader(object):
+    """Uploads reports from a pool of worker threads as they are handed over with submit(), each to today's key,
+    skipping any whose latest upload already has the same content. An identical upload from an earlier day is
+    copied within S3 instead of uploaded again.
+    """
+    def __init__(self, compress=False, workers=upload_workers):
+        self.today = str(datetime.date.today())
+        with metrics.stage('upload_listing') as record:
+            self.latest = latest_uploads(s3_connection().get_bucket(billing_bucket), self.today)
+            record['rows'] = len(self.latest)
+        self.headers = {'Content-Type': 'text/csv'}
+        if compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.compress = compress
+        self.local = threading.local()  # per worker thread: its bucket (connection), kept for every file it uploads
+        self.print_lock = threading.Lock()
+        self.pool = ThreadPool(workers)
+        self.pending = []  # (report, AsyncResult)
+        self.bytes_uploaded = 0
+
+    def submit(self, report):
+        """Start uploading a report (filename in reports_directory) that is complete on disk"""
+        self.pending.append((report, self.pool.apply_async(self.upload_one_file, (report,))))
+
+    def upload_one_file(self, report):
+        if not hasattr(self.local, 'bucket'):  # boto connections aren't thread-safe: one per worker thread
+            self.local.bucket = s3_connection().get_bucket(billing_bucket, validate=False)
+        name = key_name(report, self.today)
+        f, size, etags = prepare(report, self.compress)
+        with f:
+            previous = self.latest.get(report)
+            if previous is not None and previous.etag.strip('"') in etags:
+                if previous.name == name:
+                    result = 'unchanged'
+                else:
+                    self.local.bucket.copy_key(name, billing_bucket, previous.name)
+                    metrics.api_call('s3', billing_bucket)
+                    result = 'copied'
+            else:
+                upload(self.local.bucket, name, f, size, self.headers)
+                result = 'uploaded'
+        with self.print_lock:
+            if result == 'uploaded':
+                self.bytes_uploaded += size
+            print report + ": " + result + " (S3 bucket '" + billing_bucket + "')"
+        return result
+
+    def close(self):
+        """Wait for every submitted upload. Returns {report: 'uploaded', 'copied' or 'unchanged'}.
+        Recorded as the 'upload' stage: when reports are submitted as they are written, only the wait for the
+        uploads still running at the end.
+        """
+        self.pool.close()
+        with metrics.stage('upload', rows=len(self.pending)) as record:
+            try:
+                return dict((report, result.get()) for report, result in self.pending)
+            finally:
+                self.pool.join()
+                record['bytes'] = self.bytes_uploaded
+
+
+def upload_reports(reports, compress=False, workers=upload_workers):
+    """Upload reports (filenames in reports_directory). Returns {report: 'uploaded', 'copied' or 'unchanged'}."""
+    uploader = ReportUploader(compress, max(1, min(workers, len(reports))))
+    for report in reports:
+        uploader.submit(report)
+    return uploader.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upload everything in reports/ to the billing bucket")
+    parser.add_argument('--workers', type=int, default=upload_workers,
+                        help="files uploaded at the same time (default %d)" % upload_workers)
+    parser.add_argument('--gzip', action='store_true',
+                        help="store the reports gzipped, with Content-Encoding: gzip")
+    parser.add_argument('--profile', metavar='STAGE', help="run this stage under cProfile, see run_metrics.py")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics.profile_stage = args.profile
+    try:
+        results = upload_reports(report_files(), compress=args.gzip, workers=args.workers)
+    finally:
+        metrics.save('reports_to_bucket')
+    print ", ".join(str(results.values().count(result)) + " " + result
+                    for result in ['uploaded', 'copied', 'unchanged'])
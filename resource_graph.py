@@ -0,0 +1,53 @@
+# Which inventory resources belong to which: instance <-> volume (attachment), volume <-> snapshot (snapshot source)
+# and snapshot <-> AMI (block device mapping).
+# Every edge is indexed both ways, so "the AMIs of this snapshot" or "the instance of this volume" is a dict lookup
+# instead of a scan over every AMI or instance, and multi-hop questions are a walk over the indexes.
+
+
+class ResourceGraph(object):
+    def __init__(self):
+        # key = (from type, to type), value = {from id: [to ids, in the order the edges were added]}
+        self.edges = {}
+
+    def add(self, from_type, from_id, to_type, to_id):
+        """Relate two resources, in both directions"""
+        for key, a, b in [((from_type, to_type), from_id, to_id), ((to_type, from_type), to_id, from_id)]:
+            related = self.edges.setdefault(key, {}).setdefault(a, [])
+            if b not in related:
+                related.append(b)
+
+    def related(self, from_type, from_id, to_type):
+        """Ids of the to_type resources directly related to this one"""
+        return self.edges.get((from_type, to_type), {}).get(from_id, [])
+
+    def reachable(self, from_type, from_ids, path):
+        """Ids reached from any of from_ids by following the types in path one hop at a time,
+        e.g. reachable('instance', ids, ['volume', 'snapshot']) for the snapshots of these instances' volumes.
+        Each id is listed once, in the order it was first reached.
+        """
+        ids = list(from_ids)
+        for to_type in path:
+            reached = []
+            seen = set()
+            for res_id in ids:
+                for related_id in self.related(from_type, res_id, to_type):
+                    if related_id not in seen:
+                        seen.add(related_id)
+                        reached.append(related_id)
+            from_type, ids = to_type, reached
+        return ids
+
+    @staticmethod
+    def build(volumes, snapshots, images):
+        """Graph of the inventory's report rows (InventorySnapshot tables: id -> row)"""
+        graph = ResourceGraph()
+        for volume in volumes.values():
+            if volume['associated_instance_id'] is not None:
+                graph.add('volume', volume['id'], 'instance', volume['associated_instance_id'])
+        for snapshot in snapshots.values():
+            if snapshot['associated_volume']:
+                graph.add('snapshot', snapshot['id'], 'volume', snapshot['associated_volume'])
+        for image in images.values():
+            for snapshot_id in image['associated_snapshots']:
+                graph.add('image', image['id'], 'snapshot', snapshot_id)
+        return graph
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Re-cuts of the costs from the monthly rollup cubes cost_reporting_data.py saves (see rollup_cube.py), summed over
+# whichever months are asked for, without downloading or reading any line items: the summary report again, the
+# untagged subtotals, or costs grouped by any of the cube's dimensions, optionally filtered and pivoted.
+
+import argparse
+import csv
+import datetime
+import os
+import sys
+
+import cost_reporting_data
+from cost_reporting_data import format_cost, month_arg, months_between
+from billing_snapshot import rollup_cube_filename_format
+from rollup_cube import RollupCube, DIMENSIONS
+
+
+def write_groups(cube, by, where, columns, f):
+    """Cost per group of the by dimensions, as CSV. With columns, one column per value of that dimension (a pivot)
+    instead of a row per value, and a total column.
+    """
+    writer = csv.writer(f)
+    if columns is None:
+        writer.writerow(by + ['Cost'])
+        for group, cost in sorted(cube.group(by, where).items()):
+            writer.writerow(list(group) + [format_cost(cost)])
+        return
+    groups = cube.group(by + [columns], where)
+    column_values = sorted(set(group[-1] for group in groups))
+    rows = {}
+    for group, cost in groups.items():
+        rows.setdefault(group[:-1], {})[group[-1]] = cost
+    writer.writerow(by + column_values + ['total'])
+    for row in sorted(rows):
+        costs = rows[row]
+        writer.writerow(list(row) + [format_cost(costs.get(value, 0)) for value in column_values] +
+                        [format_cost(sum(costs.values()))])
+
+
+def dimension_arg(value):
+    """argparse type for a dimension of the cube"""
+    if value not in DIMENSIONS:
+        raise argparse.ArgumentTypeError("expected one of " + ", ".join(DIMENSIONS) + ", got " + value)
+    return value
+
+
+def where_arg(value):
+    """argparse type for "dimension=value" """
+    dimension, _, wanted = value.partition('=')
+    return dimension_arg(dimension), wanted
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summary, untagged subtotals or any breakdown of some months' costs, "
+                                                 "from the monthly rollup cubes saved by cost_reporting_data.py")
+    parser.add_argument('--month', type=month_arg, help="the month (YYYY-MM, default the current one)")
+    parser.add_argument('--from', dest='from_month', type=month_arg, help="first month of a range of months")
+    parser.add_argument('--to', dest='to_month', type=month_arg, help="last month of a --from range")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--summary', action='store_true',
+                        help="write reports/overall_keep+prod_summary.csv again (the default)")
+    action.add_argument('--untagged', action='store_true', help="print the untagged subtotals")
+    action.add_argument('--by', type=dimension_arg, action='append',
+                        help="print costs grouped by this dimension; may be repeated. Dimensions: " +
+                             ", ".join(DIMENSIONS))
+    parser.add_argument('--where', type=where_arg, action='append', default=[], metavar='DIMENSION=VALUE',
+                        help="only costs with this value of a dimension (with --by); may be repeated")
+    parser.add_argument('--columns', type=dimension_arg, metavar='DIMENSION',
+                        help="pivot: a column per value of this dimension (with --by)")
+    args = parser.parse_args()
+    if (args.where or args.columns) and not args.by:
+        parser.error("--where and --columns go with --by")
+    if args.month and (args.from_month or args.to_month):
+        parser.error("use either --month or --from/--to")
+    if args.to_month and not args.from_month:
+        parser.error("--to needs --from")
+    today = datetime.date.today().isoformat()[0:7]
+    if args.from_month:
+        args.months = months_between(args.from_month, args.to_month or today)
+    else:
+        args.months = [args.month or today]
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    missing = [month for month in args.months if not os.path.isfile(rollup_cube_filename_format % month)]
+    if missing:
+        sys.exit("No rollup cube for " + ", ".join(missing) + " (" + rollup_cube_filename_format % missing[0] +
+                 "), run cost_reporting_data.py for those months first")
+    cube = RollupCube.merge([RollupCube.load(rollup_cube_filename_format % month) for month in args.months])
+    cost_reporting_data.report_months = cube.months
+    if args.by:
+        write_groups(cube, args.by, dict(args.where), args.columns, sys.stdout)
+    elif args.untagged:
+        volume, s3, egress = cube.untagged_subtotals()
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["Untagged total for volumes", format_cost(volume)])
+        writer.writerow(["Untagged total for S3", format_cost(s3)])
+        writer.writerow(["Untagged total for data egress (some overlap with S3)", format_cost(egress)])
+    else:
+        (cost_reporting_data.untagged_volume_sum, cost_reporting_data.untagged_s3_sum,
+         cost_reporting_data.untagged_egress_sum) = cube.untagged_subtotals()
+        if not os.path.isdir("reports"):
+            os.makedirs("reports")
+        cost_reporting_data.generate_summary(cube.keeper_costs())
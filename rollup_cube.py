@@ -0,0 +1,95 @@
+# A month's costs summed over a handful of dimensions, small enough to keep and reload instantly: everything the
+# summary and the untagged subtotals need, and any other slice or pivot of them, without the line items.
+# cost_reporting_data.py saves one for every month it reports on, with cells summed in a pass over the line items its
+# backend makes anyway (or a grouped query); rollup.py re-cuts one, or the sum of several for a range of months.
+
+from array import array
+import cPickle
+import os
+
+# Operation is in there too, since data egress is partly identified by it (see generate_untagged_overview)
+DIMENSIONS = ['user:KEEP', 'user:PROD', 'ProductName', 'UsageType', 'AvailabilityZone', 'Operation']
+
+
+class RollupCube(object):
+    def __init__(self, keepers, months, cells=None):
+        self.keepers = list(keepers)  # in the order the summary lists them
+        self.months = list(months)  # the "YYYY-MM" months summed up
+        # key = tuple of DIMENSIONS values, value = cost in cost units
+        self.cells = cells if cells is not None else {}
+
+    def save(self, filename):
+        """Dictionary-encoded: each dimension's distinct values, and an array of codes per dimension"""
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        keys = list(self.cells)
+        values = []
+        codes = []
+        for i in range(len(DIMENSIONS)):
+            distinct = sorted(set(key[i] for key in keys))
+            positions = dict((value, code) for code, value in enumerate(distinct))
+            values.append(distinct)
+            codes.append(array('l', [positions[key[i]] for key in keys]).tostring())
+        saved = {'keepers': self.keepers, 'months': self.months, 'values': values,
+                 'codes': codes, 'costs': array('l', [self.cells[key] for key in keys]).tostring()}
+        with open(filename + ".tmp", 'wb') as f:
+            cPickle.dump(saved, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename + ".tmp", filename)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            saved = cPickle.load(f)
+        cube = RollupCube(saved['keepers'], saved['months'])
+        columns = [[values[code] for code in array('l', codes)] for values, codes in zip(saved['values'],
+                                                                                          saved['codes'])]
+        cube.cells = dict(zip(zip(*columns), array('l', saved['costs'])))
+        return cube
+
+    @staticmethod
+    def merge(cubes):
+        """One cube of several months' cubes. Cells are plain sums, each month's tags having been resolved already."""
+        merged = RollupCube(sorted(set().union(*[cube.keepers for cube in cubes])), [])
+        for cube in cubes:
+            merged.months.extend(cube.months)
+            for key, cost in cube.cells.items():
+                merged.cells[key] = merged.cells.get(key, 0) + cost
+        return merged
+
+    def group(self, by, where=None):
+        """{tuple of the by dimensions' values: cost} over the cells matching where ({dimension: value})"""
+        by = [DIMENSIONS.index(dimension) for dimension in by]
+        where = [(DIMENSIONS.index(dimension), value) for dimension, value in (where or {}).items()]
+        groups = {}
+        for key, cost in self.cells.items():
+            if all(key[i] == value for i, value in where):
+                group = tuple(key[i] for i in by)
+                groups[group] = groups.get(group, 0) + cost
+        return groups
+
+    def keeper_costs(self):
+        """[{prod: cost, 'user:KEEP': name}] in self.keepers order, as generate_reports hands them to the summary"""
+        by_keeper = self.group(['user:KEEP', 'user:PROD'])
+        costs = []
+        for keeper in self.keepers:
+            cost_for_keeper = dict((prod, cost) for (keep, prod), cost in by_keeper.items() if keep == keeper)
+            cost_for_keeper['user:KEEP'] = keeper or 'untagged'
+            costs.append(cost_for_keeper)
+        return costs
+
+    def untagged_subtotals(self):
+        """(volume, S3, data egress) costs of untagged line items, the same sums as rollup_untagged's"""
+        volume = s3 = egress = 0
+        for (keep, _, product, usage_type, _, operation), cost in self.cells.items():
+            if len(keep.strip()) != 0:
+                continue
+            if "Volume" in usage_type:
+                volume += cost
+            if "Amazon Simple Storage Service" in product:
+                s3 += cost
+            if "Out" in usage_type:
+                egress += cost
+            if "Out" in operation:
+                egress += cost
+        return volume, s3, egress
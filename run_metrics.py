@@ -0,0 +1,86 @@
+# What a run spent its time on, stage by stage, written to a JSON file per run so runs can be compared:
+# download, parse, sort, tag resolution, report writing, inventory fetching, uploading...
+# Any one stage can be run under cProfile instead of guessing where inside it the time goes.
+
+import cProfile
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_directory = "metrics/"
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0  # ru_maxrss is in KB on Linux
+
+
+class RunMetrics(object):
+    """Stage records and API call counts of one run. The scripts share one, run_metrics.metrics."""
+    def __init__(self):
+        self.run_id = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+        self.started = time.time()
+        self.stages = []  # one dict per stage, in the order they finished
+        self.api_calls = {}  # key = service, value = {region (or bucket): calls}
+        self.profile_stage = None  # name of the stage to run under cProfile
+        self.lock = threading.Lock()  # stages can run in several threads (pipeline.py, region workers)
+        self.local = threading.local()  # per thread: names of the stages it is in, innermost last
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """Record the wall and CPU time of the with block, the rows it processed and the peak RSS after it.
+        Yields the stage's record; set its 'rows' inside the block if they aren't known up front, and add any
+        other numbers worth keeping. CPU time is the whole process's, so it includes stages running alongside.
+        Profiling only sees the thread the stage runs in, not the worker threads or processes it hands work to.
+        """
+        parents = self.local.__dict__.setdefault('parents', [])
+        record = {'stage': name, 'parent': parents[-1] if parents else None, 'rows': rows}
+        profile = None
+        if name == self.profile_stage:
+            profile = cProfile.Profile()
+            profile.enable()
+        parents.append(name)
+        start_wall = time.time()
+        start_cpu = time.clock()
+        try:
+            yield record
+        finally:
+            seconds = time.time() - start_wall
+            parents.pop()
+            if profile is not None:
+                profile.disable()
+                record['profile'] = self.filename(name.replace(' ', '_'), ".prof")
+                profile.dump_stats(record['profile'])
+            record.update({'seconds': round(seconds, 3), 'cpu_seconds': round(time.clock() - start_cpu, 3),
+                           'rows_per_second': int(record['rows']/seconds) if record['rows'] and seconds > 0 else None,
+                           'peak_rss_mb': round(peak_rss_mb(), 1)})
+            with self.lock:
+                self.stages.append(record)
+
+    def api_call(self, service, region, calls=1):
+        """Count requests made to an AWS service, by region (or S3 bucket)"""
+        with self.lock:
+            regions = self.api_calls.setdefault(service, {})
+            regions[region] = regions.get(region, 0) + calls
+
+    def filename(self, name, extension):
+        if not os.path.isdir(metrics_directory):
+            os.makedirs(metrics_directory)
+        return metrics_directory + self.run_id + "_" + name + extension
+
+    def save(self, script):
+        """Write the run's metrics to metrics/<start time>_<script>.json, returns the filename"""
+        filename = self.filename(script, ".json")
+        with self.lock:
+            run = {'script': script, 'run_id': self.run_id, 'seconds': round(time.time() - self.started, 3),
+                   'peak_rss_mb': round(peak_rss_mb(), 1), 'stages': self.stages, 'api_calls': self.api_calls}
+        with open(filename, 'w') as f:
+            json.dump(run, f, indent=1, sort_keys=True)
+        print "Run metrics written to " + filename
+        return filename
+
+
+metrics = RunMetrics()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# Deterministic synthetic detailed billing reports (DBR zips with resources and tags), for measuring the cost
+# reporting code without real billing data or S3.
+# The same arguments always give the same file. Rows come out in hour order, like AWS's, and carry what the
+# reports have to deal with: KEEP tags in mixed case, resources that are untagged for part of the month or change
+# owner (tag churn), blank resource ids, zero-cost and non-LineItem rows, and the totals rows at the end.
+# A month-to-date report (through < 1) is a prefix of the line items of the whole month's, with its own totals, so
+# the same seed with a larger through is what the same report looks like when AWS refreshes it later on.
+
+import argparse
+import calendar
+import csv
+import os
+import random
+import zipfile
+
+from cost_reporting_data import SpreadsheetCache
+
+# Column layout of the detailed billing report with resources and tags
+DBR_FIELDS = ['InvoiceID', 'PayerAccountId', 'LinkedAccountId', 'RecordType', 'RecordId', 'ProductName', 'RateId',
+              'SubscriptionId', 'PricingPlanId', 'UsageType', 'Operation', 'AvailabilityZone', 'ReservedInstance',
+              'ItemDescription', 'UsageStartDate', 'UsageEndDate', 'UsageQuantity', 'Rate', 'Cost', 'ResourceId',
+              'user:KEEP', 'user:Name', 'user:PROD']
+
+# (resource id prefix, ProductName, Operation, usage type stems)
+RESOURCE_KINDS = [('i-', "Amazon Elastic Compute Cloud", "RunInstances",
+                   ["BoxUsage:m3.large", "BoxUsage:c4.xlarge", "DataTransfer-Out-Bytes",
+                    "DataTransfer-Regional-Bytes"]),
+                  ('vol-', "Amazon Elastic Compute Cloud", "CreateVolume-Gp2",
+                   ["EBS:VolumeUsage.gp2", "EBS:VolumeIOUsage", "EBS:SnapshotUsage"]),
+                  ('bucket-', "Amazon Simple Storage Service", "PutObject",
+                   ["TimedStorage-ByteHrs", "Requests-Tier1", "Requests-Tier2", "DataTransfer-Out-Bytes"])]
+ZONES = ["us-east-1a", "us-east-1b", "us-east-1c", ""]
+
+
+def generate(month, rows, keepers=20, resources=2000, usage_types=4, tag_churn=0.05, seed=1, directory=".",
+             through=1.0):
+    """Write the month's billing zip (named as in S3) into directory and return its path.
+    keepers: distinct KEEP tags. resources: distinct resource ids. usage_types: at most this many usage types per
+    resource. tag_churn: fraction of resources whose KEEP tag changes during the month.
+    through: fraction of the month's rows written so far, for a month-to-date report.
+    """
+    rng = random.Random(seed)
+    year, month_number = int(month[0:4]), int(month[5:7])
+    hours_in_month = calendar.monthrange(year, month_number)[1]*24
+    keeper_names = ["KEEPER%03d" % k for k in range(keepers)]
+
+    resource_list = []
+    for r in range(resources):
+        prefix, product, operation, stems = RESOURCE_KINDS[r % len(RESOURCE_KINDS)]
+        keep = rng.choice(keeper_names) if rng.random() < 0.9 else ""
+        resource = {'id': prefix + "%08x" % r, 'product': product, 'operation': operation,
+                    'usage_types': rng.sample(stems, min(usage_types, len(stems))), 'zone': rng.choice(ZONES),
+                    'keep': keep, 'prod': rng.choice(["", "yes", "YES"]),
+                    'tagged_from': rng.randrange(hours_in_month) if rng.random() < 0.2 else 0,  # untagged before
+                    'churn_at': None, 'new_keep': None}
+        if rng.random() < tag_churn:
+            resource['churn_at'] = rng.randrange(hours_in_month)
+            resource['new_keep'] = rng.choice(keeper_names)
+        resource_list.append(resource)
+
+    zip_filename = os.path.join(directory, SpreadsheetCache.billing_zip_name(month))
+    csv_filename = zip_filename[:-len(".zip")]
+    total = 0.0
+    with open(csv_filename, 'wb') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(DBR_FIELDS)
+        for i in range(int(rows*through)):
+            hour = i*hours_in_month // rows
+            start = "%s-%02d %02d:00:00" % (month, hour // 24 + 1, hour % 24)
+            end = "%s-%02d %02d:59:59" % (month, hour // 24 + 1, hour % 24)
+            draw = rng.random()
+            if draw < 0.002:
+                writer.writerow(["inv", "p", "l", rng.choice(["InvoiceTotal", "Rounding"]), "", "", "", "", "", "",
+                                 "", "", "", "total", "", "", "", "", "%.10f" % rng.random(), "", "", "", ""])
+                continue
+            resource = rng.choice(resource_list) if draw > 0.01 else None  # some usage has no resource id
+            if resource is None:
+                resource = {'id': "", 'product': "AWS Support (Business)", 'operation': "", 'usage_types': ["Dollar"],
+                            'zone': "", 'keep': "", 'prod': "", 'tagged_from': 0, 'churn_at': None}
+            keep, prod = resource['keep'], resource['prod']
+            if resource['churn_at'] is not None and hour >= resource['churn_at']:
+                keep = resource['new_keep']
+            if hour < resource['tagged_from']:
+                keep, prod = "", ""
+            if keep and rng.random() < 0.1:
+                keep = keep.lower()  # fix_case has something to do
+            cost = "0.0000000000" if rng.random() < 0.05 else "%.10f" % (rng.random()*rng.choice([0.01, 0.1, 1]))
+            total += float(cost)
+            writer.writerow(["inv", "p", "l", "LineItem", str(i), resource['product'], "r", "s", "pp",
+                             rng.choice(resource['usage_types']), resource['operation'], resource['zone'], "N",
+                             "usage", start, end, "1", "0.1", cost, resource['id'], keep, "", prod])
+        # rewritten, with the new totals, every time AWS refreshes the report
+        for record_type in ["AccountTotal", "StatementTotal"]:
+            writer.writerow(["inv", "p", "l", record_type, "", "", "", "", "", "", "", "", "",
+                             "Total statement amount", "", "", "", "", "%.10f" % total, "", "", "", ""])
+    zf = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        zf.write(csv_filename, os.path.basename(csv_filename))
+    finally:
+        zf.close()
+    os.remove(csv_filename)
+    return zip_filename
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write a synthetic detailed billing report zip")
+    parser.add_argument('--month', default="2015-06", help="YYYY-MM (default 2015-06)")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--keepers', type=int, default=20)
+    parser.add_argument('--resources', type=int, default=2000)
+    parser.add_argument('--usage-types', type=int, default=4, help="at most this many usage types per resource")
+    parser.add_argument('--tag-churn', type=float, default=0.05,
+                        help="fraction of resources whose KEEP tag changes during the month")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--directory', default=".")
+    parser.add_argument('--through', type=float, default=1.0,
+                        help="fraction of the month's rows in the report so far (default 1, the whole month)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    print generate(args.month, args.rows, args.keepers, args.resources, args.usage_types, args.tag_churn, args.seed,
+                   args.directory, args.through)
@@ -0,0 +1,94 @@
+# Per-resource history of KEEP and PROD tags, built in one pass over the (sorted) line items.
+# With hourly attribution, each resource also gets the intervals during which each non-blank KEEP/PROD value
+# applied: a sorted list of start hours and the value starting there. "Which tag applied at hour h" is then a
+# bisect, O(log n) per line item.
+
+from bisect import bisect_right
+
+
+class TagTimeline(object):
+    def __init__(self, line_items, time_comparator, hourly=True):
+        """time_comparator: line item -> hours since start of month (SpreadsheetCache.get_time_comparator).
+        It is called once per distinct UsageStartDate, not once per line item.
+        hourly: also build the intervals tags_at() needs; without them only self.latest is built, which is all
+        the default (latest tags) attribution uses.
+        """
+        self.time_comparator = time_comparator
+        self.hours_by_date = {}
+        # key = resource id, value = {'user:KEEP': name, 'user:PROD': yes/, 'age': hours}, with the same rules
+        # SpreadsheetCache.get_resource_tags always had: first line item's tags, then the newest non-blank KEEP,
+        # and the last non-blank PROD
+        self.latest = {}
+        # key = resource id, value = {'user:KEEP': ([start hours], [values]), 'user:PROD': (..., ...)}, if hourly
+        self.intervals = {}
+
+        observed = {}  # key = resource id, value = {tag: [(hours, value), ...]} in line item order
+        for row in line_items:
+            res_id = row['ResourceId']
+            hours = self.hours(row)
+            latest = self.latest.get(res_id)
+            if latest is None:
+                latest = self.latest[res_id] = {'user:KEEP': row['user:KEEP'], 'user:PROD': row['user:PROD'],
+                                                'age': hours}
+                if hourly:
+                    observed[res_id] = {'user:KEEP': [], 'user:PROD': []}
+            if len(row['user:KEEP'].strip()) != 0:
+                if hours > latest['age']:
+                    latest['user:KEEP'] = row['user:KEEP']
+                    latest['age'] = hours
+                if hourly:
+                    observed[res_id]['user:KEEP'].append((hours, row['user:KEEP']))
+            if len(row['user:PROD'].strip()) != 0:
+                latest['user:PROD'] = row['user:PROD']
+                if hourly:
+                    observed[res_id]['user:PROD'].append((hours, row['user:PROD']))
+
+        for res_id, tags in observed.items():
+            self.intervals[res_id] = dict((tag, self.collapse(values)) for tag, values in tags.items())
+
+    @staticmethod
+    def collapse(observations):
+        """[(hours, value), ...] -> ([start hours], [values]), merging consecutive hours with the same value.
+        The observations come in sort_data order (by KEEP, PROD, Operation... within a resource), and the sort by
+        hours is stable, so of two values in the same hour the one that sorts later wins, not the later one in time.
+        """
+        starts = []
+        values = []
+        for hours, value in sorted(observations, key=lambda observation: observation[0]):
+            if values and values[-1] == value:
+                continue
+            if starts and starts[-1] == hours:  # two values in the same hour: the later one in sort_data order
+                values[-1] = value
+                continue
+            starts.append(hours)
+            values.append(value)
+        return starts, values
+
+    def hours(self, row):
+        date_time = row.get('UsageStartDate')
+        hours = self.hours_by_date.get(date_time)
+        if hours is None:
+            hours = self.hours_by_date[date_time] = self.time_comparator(row)
+        return hours
+
+    def tag_at(self, res_id, tag, hours):
+        """Value of tag ('user:KEEP' or 'user:PROD') in effect for this resource at this hour.
+        Before the resource was first tagged, that first tag (back-filling); "" if it never was.
+        """
+        starts, values = self.intervals[res_id][tag]
+        if not values:
+            return ""
+        return values[max(bisect_right(starts, hours) - 1, 0)]
+
+    def tags_at(self, row):
+        """(KEEP, PROD) for a line item, attributing by the tags in effect at its own hour. Needs hourly.
+        A line item's own non-blank tag always stands; blank ones get the tag in effect at the time.
+        """
+        hours = self.hours(row)
+        keep = row['user:KEEP']
+        prod = row['user:PROD']
+        if len(keep.strip()) == 0:
+            keep = self.tag_at(row['ResourceId'], 'user:KEEP', hours) or keep
+        if len(prod.strip()) == 0:
+            prod = self.tag_at(row['ResourceId'], 'user:PROD', hours) or prod
+        return keep, prod
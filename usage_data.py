@@ -8,38 +8,119 @@ __author__ = 'cleung'
 # TODO: easier for humans to identify than the resource_ids
 # TODO: Consider making it TSV so that we can list snapshots (or other fields) with commas and it'll still work
 
+import argparse
 import os
 import sys
+import time
 import boto
 from boto import ec2
+from boto.ec2.instance import Reservation
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 import csv
 
+from connections import ec2_connection
+from inventory_cache import InventoryCache, RESOURCE_TYPES, diff_tables
+from resource_graph import ResourceGraph
+from run_metrics import metrics
+
 # Name your output files
 volumes_data_output_file = "reports/volumes.csv"
 snapshots_data_output_file = "reports/snapshots.csv"
 instances_data_output_file = "reports/instances.csv"
 images_data_output_file = "reports/images.csv"
-
-class Resource(object):
-    def __init__(self, res_type):
-        self.res_type = res_type
-        self.spreadsheet = {}
+inventory_changes_output_file = "reports/inventory_changes.csv"
+
+region_workers = 8  # regions queried at the same time
+# Seconds a resource type is taken from the inventory cache instead of being fetched again.
+# Snapshots and AMIs are the slow ones to enumerate and change least often.
+inventory_ttl = {'instance': 15*60, 'volume': 15*60, 'snapshot': 6*60*60, 'image': 6*60*60}
+page_size = 500  # MaxResults of each Describe* call (5 to 500 for volumes, 5 to 1000 for instances and snapshots)
+
+
+def describe_pages(conn, action, markers, params=None, filters=None):
+    """ResultSets of a paginated Describe* call, page_size items at a time, following NextToken.
+    A page can be processed and dropped before the next one is requested.
+    """
+    params = dict(params or {})
+    if filters:
+        conn.build_filter_params(params, filters)
+    params['MaxResults'] = page_size
+    while True:
+        page = conn.get_list(action, params, markers, verb='POST')
+        metrics.api_call('ec2', conn.region.name)
+        yield page
+        if not page.next_token:
+            break
+        params['NextToken'] = page.next_token
+
+
+class InventorySnapshot(object):
+    """Instances, volumes, snapshots and AMIs of every region, fetched in one pass over the regions.
+    Each table is a dict: key = resource id, value = the row the reports are written from.
+    Resource types fetched less than their TTL ago (see inventory_ttl) come from the InventoryCache instead.
+    """
+    def __init__(self, workers=region_workers, ttl=None, refresh=False, filters=None, owner='self'):
+        """ttl: resource type -> seconds, default inventory_ttl. refresh: fetch everything, whatever the TTLs.
+        filters: resource type -> EC2 filters ({name: [values]}) applied server-side, e.g.
+        {'instance': {'instance-state-name': ['running']}}. owner: whose snapshots and AMIs to list.
+        """
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.images = {}
 
         self.region_names = []
         self.get_regions()
 
         self.credentials = self.get_credentials()
-
-        # populate depending on type
-        if self.res_type == "instance":
-            self.populate_instances()
-        elif self.res_type == "snapshot":
-            self.populate_snapshots()
-        elif self.res_type == "volume":
-            self.populate_volumes()
-        elif self.res_type == "image":
-            self.populate_images()
+        self.workers = workers
+        self.connections = {}  # key = region name, value = its EC2 connection, reused by every call to the region
+
+        self.owner = owner
+        self.filters = dict((res_type, (filters or {}).get(res_type, {})) for res_type in RESOURCE_TYPES)
+        # what decides which resources of a type are listed: cached rows fetched another way can't be reused
+        selection = dict((res_type, (self.filters[res_type], owner if res_type in ['snapshot', 'image'] else None))
+                         for res_type in RESOURCE_TYPES)
+
+        ttl = inventory_ttl if ttl is None else ttl
+        cache = InventoryCache.load()
+        self.stale = [res_type for res_type in RESOURCE_TYPES
+                      if refresh or not cache.is_fresh(res_type, ttl[res_type], selection[res_type])]
+        previous = dict((res_type, cache.rows(res_type)) for res_type in RESOURCE_TYPES)  # the last run's tables
+
+        fetched = time.time()
+        if self.stale:
+            print "Fetching " + ", ".join(self.stale) + " info..."
+            with metrics.stage('inventory_fetch') as record:
+                per_region = self.for_all_regions(self.fetch_region)
+                record['rows'] = sum(len(rows) for region_rows in per_region for rows in region_rows.values())
+        for res_type in RESOURCE_TYPES:
+            if res_type in self.stale:
+                print "Populating " + res_type + "s info..."
+                setattr(self, res_type + 's', dict((row['id'], row) for region_rows in per_region
+                                                   for row in region_rows[res_type]))
+            else:
+                print "Using cached " + res_type + " info..."
+                setattr(self, res_type + 's', cache.rows(res_type))
+        with metrics.stage('inventory_link', rows=sum(len(self.table(res_type)) for res_type in RESOURCE_TYPES)):
+            self.graph = ResourceGraph.build(self.volumes, self.snapshots, self.images)
+            self.link()
+
+        self.changes = []  # (change, resource type, id, region, old tags, new tags), see inventory_cache.diff_tables
+        self.changed_types = []  # resource types whose report would come out different from last run's
+        for res_type in RESOURCE_TYPES:
+            table = self.table(res_type)
+            self.changes.extend(diff_tables(res_type, previous[res_type], table))
+            if table != previous[res_type]:
+                self.changed_types.append(res_type)
+            cache.store(res_type, table, selection[res_type], fetched if res_type in self.stale else None)
+        cache.save()
+
+    def table(self, res_type):
+        return getattr(self, res_type + 's')
 
     def get_credentials(self):
         return {"aws_access_key_id": os.environ['AWS_ACCESS_KEY'],
@@ -50,55 +131,68 @@ class Resource(object):
         for region in regions:
             self.region_names.append(region.name)
 
+    def connection(self, region):
+        """The region's pooled connection, opened on first use"""
+        conn = self.connections.get(region)
+        if conn is None:
+            conn = self.connections[region] = ec2_connection(region, self.credentials)
+        return conn
+
+    def for_all_regions(self, get_region):
+        """[get_region(region) for region in self.region_names], self.workers regions at a time.
+        Results are in region order, so they are the same as a serial loop's.
+        Each region is handled by one thread, so its connection is never shared between threads.
+        """
+        pool = ThreadPool(max(1, min(self.workers, len(self.region_names))))
+        try:
+            return pool.map(get_region, self.region_names)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch_region(self, region):
+        """{resource type: report rows} of one region, for every stale resource type, all over its one connection"""
+        getters = {'instance': self.get_instances, 'volume': self.get_volumes, 'snapshot': self.get_snapshots,
+                   'image': self.get_images}
+        return dict((res_type, getters[res_type](region)) for res_type in self.stale)
+
     def get_volumes(self, region):
-        """Return list of whole volumes for a given region"""
+        """Return report rows of the volumes in a given region, converted a page at a time"""
         try:
-            conn = ec2.connect_to_region(region, **self.credentials)
-            region_volumes = conn.get_all_volumes()
+            conn = self.connection(region)
+            region_volumes = [self.volume_row(i) for page in describe_pages(conn, 'DescribeVolumes', [('item', Volume)],
+                                                                            filters=self.filters['volume'])
+                              for i in page]
         except boto.exception.EC2ResponseError:
             return []  # This better not fail silently or I'll cut a person.
         return region_volumes
 
-    def get_all_volumes(self):
-        all_volumes = []
-        for region in self.region_names:
-            all_volumes.extend(self.get_volumes(region))
-        return all_volumes
-
     def get_instances(self, region):
-        """Return list of whole instances for given region"""
+        """Return report rows of the instances in a given region, converted a page at a time"""
         try:
-            conn = ec2.connect_to_region(region, **self.credentials)
+            conn = self.connection(region)
             region_instances = []
-            reservations = conn.get_all_reservations()
-            for reservation in reservations:
-                for instance in reservation.instances:
-                    region_instances.append(instance)
+            for reservations in describe_pages(conn, 'DescribeInstances', [('item', Reservation)],
+                                               filters=self.filters['instance']):
+                for reservation in reservations:
+                    for instance in reservation.instances:
+                        region_instances.append(self.instance_row(instance))
         except boto.exception.EC2ResponseError:
             return []
         return region_instances
 
-    def get_all_instances(self):
-        all_instances = []
-        for region in self.region_names:
-            all_instances.extend(self.get_instances(region))
-        return all_instances
-
     def get_snapshots(self, region):
-        """Return list of whole snapshots for a given region"""
+        """Return report rows of the snapshots in a given region, converted a page at a time"""
         try:
-            conn = ec2.connect_to_region(region, **self.credentials)
-            region_snapshots = conn.get_all_snapshots(owner='self')
+            conn = self.connection(region)
+            region_snapshots = [self.snapshot_row(i) for page in
+                                describe_pages(conn, 'DescribeSnapshots', [('item', Snapshot)],
+                                               params={'Owner.1': self.owner}, filters=self.filters['snapshot'])
+                                for i in page]
         except boto.exception.EC2ResponseError:
             return []
         return region_snapshots
 
-    def get_all_snapshots(self):
-        all_snapshots = []
-        for region in self.region_names:
-            all_snapshots.extend(self.get_snapshots(region))
-        return all_snapshots
-
     @staticmethod
     def get_name_tag(obj):
         """ 'Name' is an optional tag. Get it if it exists."""
@@ -119,16 +213,14 @@ class Resource(object):
     def is_production(obj):
         return 'PROD' in obj.tags
 
-    @staticmethod
-    def get_amis_of(snapshot_id):
+    def get_amis_of(self, snapshot_id):
         """Get the AMI ids associated with a given snapshot"""
-        mes_amis = []
-        # There has GOT to be a better way. Hmm... maybe not
-        keys = Ims.spreadsheet.keys()
-        for key in keys:
-            if snapshot_id in Ims.spreadsheet[key]['associated_snapshots']:
-                mes_amis.append(key)
-        return mes_amis
+        return self.graph.related('snapshot', snapshot_id, 'image')
+
+    def snapshots_of_keeper(self, keep_tag):
+        """Ids of the snapshots taken of volumes attached to this KEEP tag's instances"""
+        instance_ids = [row['id'] for row in self.instances.values() if row['KEEP_tag'] == keep_tag]
+        return self.graph.reachable('instance', sorted(instance_ids), ['volume', 'snapshot'])
 
     @staticmethod
     def get_snapshots_of(image):
@@ -142,88 +234,74 @@ class Resource(object):
         return snapshot_ids
 
     def get_images(self, region):
-        """Get whole AMIs for a given region"""
+        """Get report rows of the AMIs for a given region. DescribeImages isn't paginated, but it is filtered."""
         try:
-            conn = ec2.connect_to_region(region, **self.credentials)
-            region_images = conn.get_all_images(owners=['self'])
+            conn = self.connection(region)
+            region_images = [self.image_row(i) for i in conn.get_all_images(owners=[self.owner],
+                                                                            filters=self.filters['image'] or None)]
+            metrics.api_call('ec2', region)
         except boto.exception.EC2ResponseError:
             return []
         return region_images
 
-    def get_all_images(self):
-        all_images = []
-        for region in self.region_names:
-            all_images.extend(self.get_images(region))
-        return all_images
-
-    def populate_images(self):
-        """Dict of dicts for images"""
-        print "Populating images info..."
-        images = self.get_all_images()
-        for i in images:
-
-            associated_snapshots = self.get_snapshots_of(i)
-
-            self.spreadsheet[i.id] = dict(name=i.name, Name_tag=self.get_name_tag(i), id=i.id,
-                                          KEEP_tag=self.get_keep_tag(i), PROD_tag=self.is_production(i),
-                                          region=i.region.name,
-                                          created=i.creationDate,
-                                          associated_snapshots=associated_snapshots,
-                                          description=i.description)
-
-    def populate_volumes(self):
-        """Dictionary of dictionaries representing volumes"""
-        print "Populating volumes info..."
-        volumes = self.get_all_volumes()
-        for i in volumes:
-
-            # handle associated instance's KEEP-tag
-            associated_instance_id = i.attach_data.instance_id
-
-            if associated_instance_id is None:  # sometimes there is no attached instance
-                instance_keep_tag = "-------no-instance-found"
-            else:
-                instance_keep_tag = Ins.spreadsheet[associated_instance_id]['KEEP_tag']
-            self.spreadsheet[i.id] = dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
-                                          instance_KEEP_tag=instance_keep_tag,
-                                          associated_instance_id=associated_instance_id,
-                                          PROD_tag=self.is_production(i), attachment_state=i.attachment_state(),
-                                          state=i.volume_state(), status=i.status, iops=i.iops, size=i.size,
-                                          created=i.create_time, region=i.region.name)
-
-    def populate_instances(self):
-        """Make a dictionary of dictionaries with the all fields we want
-        Dict is nice so that we can easily look up instance KEEP-tags later.
+    def image_row(self, i):
+        """Dict for an image"""
+        associated_snapshots = self.get_snapshots_of(i)
+
+        return dict(name=i.name, Name_tag=self.get_name_tag(i), id=i.id,
+                    KEEP_tag=self.get_keep_tag(i), PROD_tag=self.is_production(i),
+                    region=i.region.name,
+                    created=i.creationDate,
+                    associated_snapshots=associated_snapshots,
+                    description=i.description)
+
+    def volume_row(self, i):
+        """Dictionary representing a volume"""
+        # the associated instance's KEEP-tag is filled in by link()
+        return dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
+                    associated_instance_id=i.attach_data.instance_id,
+                    PROD_tag=self.is_production(i), attachment_state=i.attachment_state(),
+                    state=i.volume_state(), status=i.status, iops=i.iops, size=i.size,
+                    created=i.create_time, region=i.region.name)
+
+    def instance_row(self, i):
+        """Make a dictionary with the all fields we want
+        Tables of these make it easy to look up instance KEEP-tags later.
         """
-        print "Populating instances info..."
-        instances = self.get_all_instances()
-        for i in instances:
-            self.spreadsheet[i.id] = dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
-                                          PROD_tag=self.is_production(i), instance_type=i.instance_type,
-                                          state=i.state, launched=i.launch_time, region=i.region.name)
-
-    def populate_snapshots(self):
-        """Dict of dicts for snapshots"""
-        print "Populating snapshots info..."
-        snapshots = self.get_all_snapshots()
-
-        for i in snapshots:
+        return dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
+                    PROD_tag=self.is_production(i), instance_type=i.instance_type,
+                    state=i.state, launched=i.launch_time, region=i.region.name)
+
+    def snapshot_row(self, i):
+        """Dict for a snapshot"""
+        # the associated AMIs and their KEEP-tags are filled in by link()
+        return dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
+                    PROD_tag=self.is_production(i), start_time=i.start_time,
+                    region=i.region.name, associated_volume=i.volume_id,
+                    volume_size=i.volume_size, description=i.description)
+
+    def link(self):
+        """Fill in the fields that come from related resources, once all four tables are there
+        (fetched or cached): the KEEP-tags of volumes' instances and snapshots' AMIs
+        """
+        for row in self.volumes.values():
+            associated_instance_ids = self.graph.related('volume', row['id'], 'instance')
+            if not associated_instance_ids or associated_instance_ids[0] not in self.instances:
+                # sometimes there is no attached instance
+                row['instance_KEEP_tag'] = "-------no-instance-found"
+            else:
+                row['instance_KEEP_tag'] = self.instances[associated_instance_ids[0]]['KEEP_tag']
 
+        for row in self.snapshots.values():
             # find the ami id(s) for this snapshot. API allows for multiple even though I don't think there would be
-            associated_ami_ids = self.get_amis_of(i.id)
-
-            ami_keep_tags = [Ims.spreadsheet[ami_id]['KEEP_tag'] for ami_id in associated_ami_ids]
+            associated_ami_ids = self.get_amis_of(row['id'])
+            row['associated_ami_ids'] = associated_ami_ids
+            row['ami_KEEP_tag'] = [self.images[ami_id]['KEEP_tag'] for ami_id in associated_ami_ids]
 
-            self.spreadsheet[i.id] = dict(Name_tag=self.get_name_tag(i), id=i.id, KEEP_tag=self.get_keep_tag(i),
-                                          ami_KEEP_tag=ami_keep_tags, associated_ami_ids=associated_ami_ids,
-                                          PROD_tag=self.is_production(i), start_time=i.start_time,
-                                          region=i.region.name, associated_volume=i.volume_id,
-                                          volume_size=i.volume_size, description=i.description)
-
-def generate_volumes_report():
+def generate_volumes_report(inventory):
     # sort it, well, this is messy, do I have to turn it into a list? Seems like it.
-    list_volumes = sorted(Vols.spreadsheet.values(), key=itemgetter('instance_KEEP_tag', 'KEEP_tag', 'region',
-                                                                    'created'))
+    list_volumes = sorted(inventory.volumes.values(), key=itemgetter('instance_KEEP_tag', 'KEEP_tag', 'region',
+                                                                     'created'))
 
     # dump it to see what it looks like
     print "Writing to file..."
@@ -240,9 +318,9 @@ def generate_volumes_report():
                              'status': row['status'], 'iops': row['iops'], 'size': row['size'],
                              'created': row['created'], 'region': row['region']})
 
-def generate_snapshots_report():
-    list_snapshots = sorted(Snaps.spreadsheet.values(), key=itemgetter('ami_KEEP_tag', 'KEEP_tag', 'region',
-                                                                       'start_time'))
+def generate_snapshots_report(inventory):
+    list_snapshots = sorted(inventory.snapshots.values(), key=itemgetter('ami_KEEP_tag', 'KEEP_tag', 'region',
+                                                                         'start_time'))
 
     # dump it to see what it looks like
     print "Writing to file " + snapshots_data_output_file + "..."
@@ -275,8 +353,8 @@ def generate_snapshots_report():
                              'description': row['description']})
 
 
-def generate_instances_report():
-    list_instances = sorted(Ins.spreadsheet.values(), key=itemgetter('KEEP_tag', 'region', 'launched'))
+def generate_instances_report(inventory):
+    list_instances = sorted(inventory.instances.values(), key=itemgetter('KEEP_tag', 'region', 'launched'))
 
     # dump it to see what it looks like
     print "Writing to file " + instances_data_output_file + "..."
@@ -291,8 +369,8 @@ def generate_instances_report():
 
 
 
-def generate_images_report():
-    list_images = sorted(Ims.spreadsheet.values(), key=itemgetter('KEEP_tag', 'region', 'created'))
+def generate_images_report(inventory):
+    list_images = sorted(inventory.images.values(), key=itemgetter('KEEP_tag', 'region', 'created'))
 
     # dump it to see what it looks like
     print "Writing to file " + images_data_output_file + "..."
@@ -319,17 +397,117 @@ def generate_images_report():
                              'associated snapshots': associated_snap_ids, 'description': row['description']})
 
 
-def main():
+def generate_changes_report(inventory):
+    """Resources created, deleted or retagged since the last run"""
+    print "Writing to file " + inventory_changes_output_file + "..."
+    with open(inventory_changes_output_file, 'w') as f:
+        fields = ['change', 'resource type', 'id', 'region', 'old KEEP tag', 'new KEEP tag', 'old production?',
+                  'new production?', 'old Name', 'new Name']
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for change, res_type, res_id, region, old_tags, new_tags in inventory.changes:
+            row = {'change': change, 'resource type': res_type, 'id': res_id, 'region': region}
+            if old_tags is not None:
+                row.update({'old KEEP tag': old_tags['KEEP_tag'], 'old production?': old_tags['PROD_tag'],
+                            'old Name': old_tags['Name_tag']})
+            if new_tags is not None:
+                row.update({'new KEEP tag': new_tags['KEEP_tag'], 'new production?': new_tags['PROD_tag'],
+                            'new Name': new_tags['Name_tag']})
+            writer.writerow(row)
+
+
+# resource type -> (its report, the function writing it)
+report_generators = [('volume', volumes_data_output_file, generate_volumes_report),
+                     ('snapshot', snapshots_data_output_file, generate_snapshots_report),
+                     ('instance', instances_data_output_file, generate_instances_report),
+                     ('image', images_data_output_file, generate_images_report)]
+
+
+def main(inventory, report_done=None):
+    """report_done(path), if given, is called as soon as each report file is complete, e.g. to start uploading it"""
     # import pdb; pdb.set_trace()
-    generate_volumes_report()
-    generate_snapshots_report()
-    generate_instances_report()
-    generate_images_report()
+    if report_done is None:
+        report_done = lambda path: None
+    for res_type, output_file, generate_report in report_generators:
+        # a report is only written again if its rows changed since the last run, or it isn't there any more
+        if res_type in inventory.changed_types or not os.path.isfile(output_file):
+            with metrics.stage(res_type + "_report", rows=len(inventory.table(res_type))):
+                generate_report(inventory)
+        else:
+            print output_file + " is unchanged"
+        report_done(output_file)
+    with metrics.stage('changes_report', rows=len(inventory.changes)):
+        generate_changes_report(inventory)
+    report_done(inventory_changes_output_file)
+    print str(len(inventory.changes)) + " resources created, deleted or retagged since the last run"
     print "done"
 
+
+def ttl_arg(value):
+    """argparse type for "type=seconds", e.g. "snapshot=3600" """
+    res_type, _, seconds = value.partition('=')
+    if res_type not in RESOURCE_TYPES or not seconds.isdigit():
+        raise argparse.ArgumentTypeError("expected one of " + ", ".join(RESOURCE_TYPES) + "=seconds, got " + value)
+    return res_type, int(seconds)
+
+
+def page_size_arg(value):
+    """argparse type for a MaxResults every Describe* call accepts: EC2 rejects the call outside 5 to 500 (for
+    volumes), and a rejected call would look like a region without any of that resource
+    """
+    if not value.isdigit() or not 5 <= int(value) <= 500:
+        raise argparse.ArgumentTypeError("expected a page size from 5 to 500, got " + value)
+    return int(value)
+
+
+def add_arguments(parser):
+    """The inventory options, on this script's parser or pipeline.py's (see check_args)"""
+    parser.add_argument('--region-workers', type=int, default=region_workers,
+                        help="regions queried at the same time (default %d, 1 is serial)" % region_workers)
+    parser.add_argument('--ttl', type=ttl_arg, action='append', default=[], metavar='TYPE=SECONDS',
+                        help="reuse the cached inventory of a resource type (instance, volume, snapshot, image) "
+                             "fetched less than this long ago; may be repeated. Defaults: " +
+                             ", ".join("%s=%d" % (res_type, inventory_ttl[res_type]) for res_type in RESOURCE_TYPES))
+    parser.add_argument('--refresh', action='store_true', help="fetch everything again, whatever the TTLs")
+    parser.add_argument('--instance-state', action='append', default=[],
+                        help="only list instances in this state (e.g. running); may be repeated")
+    parser.add_argument('--volume-state', action='append', default=[],
+                        help="only list volumes in this state (e.g. in-use); may be repeated")
+    parser.add_argument('--tag-key', action='append', default=[],
+                        help="only list resources that have this tag (e.g. KEEP); may be repeated")
+    parser.add_argument('--owner', default='self', help="account whose snapshots and AMIs to list (default self)")
+    parser.add_argument('--page-size', type=page_size_arg, default=page_size,
+                        help="resources per Describe* call, 5 to 500 (default %d)" % page_size)
+
+
+def check_args(args):
+    """Turn add_arguments' options into what InventorySnapshot takes: args.ttl for every type, and args.filters"""
+    args.ttl = dict(inventory_ttl, **dict(args.ttl))
+    args.filters = dict((res_type, {}) for res_type in RESOURCE_TYPES)
+    if args.instance_state:
+        args.filters['instance']['instance-state-name'] = args.instance_state
+    if args.volume_state:
+        args.filters['volume']['status'] = args.volume_state
+    if args.tag_key:
+        for res_type in RESOURCE_TYPES:
+            args.filters[res_type]['tag-key'] = args.tag_key
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reports of the live instances, volumes, snapshots and AMIs")
+    add_arguments(parser)
+    parser.add_argument('--profile', metavar='STAGE',
+                        help="run this stage (e.g. inventory_fetch) under cProfile, see run_metrics.py")
+    args = parser.parse_args()
+    check_args(args)
+    return args
+
 if __name__ == '__main__':
-    Ins = Resource('instance')
-    Vols = Resource('volume')
-    Ims = Resource('image')
-    Snaps = Resource('snapshot')
-    main()
+    args = parse_args()
+    page_size = args.page_size
+    metrics.profile_stage = args.profile
+    try:
+        main(InventorySnapshot(workers=args.region_workers, ttl=args.ttl, refresh=args.refresh, filters=args.filters,
+                               owner=args.owner))
+    finally:
+        metrics.save('usage_data')